@@ -1,131 +1,464 @@
+import time
+STARTUP_STARTED = time.perf_counter()  # Taken before the other imports so they are part of the startup report
+
 import discord
 from discord.ext import commands, tasks
 from discord import app_commands
 from dotenv import load_dotenv
-import aiosqlite
 import os
 import sys
 import aiohttp
 import asyncio
 import random
 import string
-import numpy as np
 import io
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
+import json
+import hashlib
+import contextlib
+import heapq
 import datetime
-from datetime import date, datetime, timedelta
-import pnwkit
-import concurrent.futures
-from db import DatabaseUser
+from datetime import date, datetime, timedelta, timezone
+from collections import OrderedDict
+from db import DatabaseUser, HISTORY_PERIODS, normalize_payout_date
+import charts  # Light: the plotting stack is only imported inside the render workers
+from matching import MatchingEngine
+from pnw import PnWClient, PnWError, NationCache, API_URL
 
 # Load environment variables
 load_dotenv()
 TOKEN = os.getenv('TOKEN')
 PNW_API_KEY = os.getenv('PNW_API_KEY')
-kit = pnwkit.QueryKit(PNW_API_KEY)
 LOG_CHANNEL_ID = 1283031424399839263
+# Price changes are recorded as they happen; every company's price is also written this often
+# as a keyframe. Set it to 1 to sample every company every minute.
+PRICE_KEYFRAME_MINUTES = int(os.getenv('PRICE_KEYFRAME_MINUTES', '60'))
+# Render processes kept warm for graphs, and how many graphs may be in flight at once
+GRAPH_WORKERS = int(os.getenv('GRAPH_WORKERS', '2'))
+GRAPH_MAX_PENDING = int(os.getenv('GRAPH_MAX_PENDING', '8'))
+# How long nation lookups are kept in memory and in the nations table, in seconds
+NATION_CACHE_TTL = int(os.getenv('NATION_CACHE_TTL', str(6 * 3600)))
+NATION_DB_TTL = int(os.getenv('NATION_DB_TTL', str(24 * 3600)))
+# Every registered nation is refreshed into the nations table this often, in batches of ids per query.
+# Keep it shorter than NATION_DB_TTL so lookups for registered nations never need the API.
+NATION_SYNC_HOURS = float(os.getenv('NATION_SYNC_HOURS', '6'))
+NATION_SYNC_BATCH = int(os.getenv('NATION_SYNC_BATCH', '500'))
 verification_codes={}
 AUTHORIZED_ROLE_ID = int(os.getenv('AUTHORIZED_ROLE_ID'))
 
 intents = discord.Intents.all()
 bot = commands.Bot(command_prefix="!", intents=intents)
 db = DatabaseUser()
-
+graph_renderer = charts.GraphRenderer(workers=GRAPH_WORKERS, max_pending=GRAPH_MAX_PENDING)
+matching_engine = MatchingEngine(db)
+pnw = PnWClient(PNW_API_KEY, url=os.getenv('PNW_API_URL', API_URL))
+nation_cache = NationCache(pnw, db, ttl=NATION_CACHE_TTL, db_ttl=NATION_DB_TTL)
+
+# Seconds spent in each startup step, reported once the bot is ready
+startup_timings = {"imports": time.perf_counter() - STARTUP_STARTED}
+
+async def sync_command_tree():
+    # Only push the slash commands to Discord when their definitions changed since the last sync.
+    # The hash is stored per application, so running the same database under another application
+    # (a different token) still registers the commands there.
+    payload = json.dumps([command.to_dict(bot.tree) for command in bot.tree.get_commands()], sort_keys=True)
+    digest = hashlib.sha256(payload.encode()).hexdigest()
+    key = f"command_tree_hash:{bot.application_id}"
+    if bot.application_id is not None and await db.get_meta(key) == digest:
+        return False
+    await bot.tree.sync()
+    await db.set_meta(key, digest)
+    return True
 
 @bot.event
 async def on_ready():
     print(f'Logged in as {bot.user}!')
-    await db.init_db()
-    await bot.tree.sync()
-    update_share_prices.start()
-async def log_transaction(company_name: str, num_shares: int, share_price: float, total_value: float, user_id: str, transaction_type: str):
-    log_channel = bot.get_channel(LOG_CHANNEL_ID)
-    
-    if log_channel:
-        log_message = (
-            f"{transaction_type} Transaction Log:\n"
-            f"User ID: {user_id}\n"
-            f"Company: {company_name}\n"
-            f"Shares {transaction_type}d: {num_shares}\n"
-            f"Share Price: {share_price}\n"
-            f"Total {transaction_type} Value: {total_value}\n"
-            f"Time: {datetime.now().isoformat()}"
-        )
-        await log_channel.send(log_message)
-    else:
-        print(f"Log channel with ID {LOG_CHANNEL_ID} not found.")
-        
-
-async def generate_graph_in_background(company_name, times, prices, period):
-    loop = asyncio.get_event_loop()
-    with concurrent.futures.ThreadPoolExecutor() as pool:
-        return await loop.run_in_executor(pool, lambda: create_and_save_graph(company_name, times, prices, period))
+    # on_ready fires again after every reconnect; the startup work only needs doing once
+    if "ready" in startup_timings:
+        return
 
-def create_and_save_graph(company_name, times, prices, period):
-    # Create the plot
-    plt.figure(figsize=(10, 5))
+    started = time.perf_counter()
+    synced = await sync_command_tree()
+    startup_timings["tree.sync"] = time.perf_counter() - started
+    update_share_prices.start()
+    transaction_log.start()
+    dividend_scheduler.start()
+    sync_nations.start()
+    startup_timings["ready"] = time.perf_counter() - STARTUP_STARTED
+
+    print(
+        "Startup timings: "
+        f"imports {startup_timings['imports']:.3f}s, "
+        f"init_db {startup_timings['init_db']:.3f}s, "
+        f"order books and dividends {startup_timings['state']:.3f}s, "
+        f"tree.sync {startup_timings['tree.sync']:.3f}s{'' if synced else ' (unchanged, skipped)'}, "
+        f"ready {startup_timings['ready']:.3f}s after start"
+    )
 
-    # Plot with different colors based on price direction
-    for i in range(1, len(prices)):
-        if prices[i] > prices[i - 1]:
-            plt.plot([times[i-1], times[i]], [prices[i-1], prices[i]], color='green', linewidth=2, marker='o')
+class Paginator(discord.ui.View):
+    # Previous/next buttons over pages of embeds. fetch_page(page) returns the embeds for a
+    # zero-based page, so pages can be built up front or queried as the user flips through them.
+    def __init__(self, fetch_page, page_count, user_id, timeout=300):
+        super().__init__(timeout=timeout)
+        self.fetch_page = fetch_page
+        self.page_count = page_count
+        self.user_id = user_id
+        self.page = 0
+        self.update_buttons()
+
+    def update_buttons(self):
+        self.previous_page.disabled = self.page <= 0
+        self.next_page.disabled = self.page >= self.page_count - 1
+
+    async def embeds_for_page(self):
+        embeds = await self.fetch_page(self.page)
+        embeds[-1].set_footer(text=f"Page {self.page + 1}/{self.page_count}")
+        return embeds
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        # Only whoever ran the command can flip its pages
+        if interaction.user.id != self.user_id:
+            await interaction.response.send_message("Run the command yourself to page through it.", ephemeral=True)
+            return False
+        return True
+
+    @discord.ui.button(label="◀ Previous", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page -= 1
+        await self.show(interaction)
+
+    @discord.ui.button(label="Next ▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page += 1
+        await self.show(interaction)
+
+    async def show(self, interaction: discord.Interaction):
+        self.update_buttons()
+        await interaction.response.edit_message(embeds=await self.embeds_for_page(), view=self)
+
+async def send_paginated(interaction: discord.Interaction, fetch_page, page_count, ephemeral=False):
+    # Sends the first page; the buttons are only attached when there is more than one page
+    if page_count > 1:
+        view = Paginator(fetch_page, page_count, interaction.user.id)
+        await interaction.response.send_message(embeds=await view.embeds_for_page(), view=view, ephemeral=ephemeral)
+    else:
+        await interaction.response.send_message(embeds=await fetch_page(0), ephemeral=ephemeral)
+
+def pack_embeds(embeds, max_embeds=10, max_characters=6000):
+    # Group embeds into messages within Discord's limits of 10 embeds and 6000 characters each
+    pages = []
+    for embed in embeds:
+        if pages and len(pages[-1]) < max_embeds and sum(len(e) for e in pages[-1]) + len(embed) <= max_characters:
+            pages[-1].append(embed)
         else:
-            plt.plot([times[i-1], times[i]], [prices[i-1], prices[i]], color='red', linewidth=2, marker='o')
-
-    # Format and style the graph
-    plt.title(f"Share Price History for {company_name} ({period})")
-    plt.xlabel('Time')
-    plt.ylabel('Share Price')
-    plt.grid(True)
-    plt.xticks(rotation=45)
-
-    # Adjust the x-axis to show only key time points, not cluttered data
-    if period in ['1h', '12h']:
-        plt.gca().xaxis.set_major_locator(plt.MaxNLocator(10))  # Adjust for shorter periods
-    elif period in ['1d', '3d', '7d']:
-        plt.gca().xaxis.set_major_locator(plt.MaxNLocator(6))  # Adjust for longer periods
-
-    # Save the plot to a BytesIO object
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png')
-    buf.seek(0)
-    plt.close()
+            pages.append([embed])
+    return pages
+
+class RenderCache:
+    # Size-bounded LRU cache of rendered graph PNGs
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_entries=256):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        png = self.entries.get(key)
+        if png is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return png
+
+    def put(self, key, png):
+        if len(png) > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.entries[key] = png
+        self.size += len(png)
+        # Drop the least recently used graphs until back under both limits
+        while self.size > self.max_bytes or len(self.entries) > self.max_entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.size
+        }
+
+graph_cache = RenderCache()
+
+class TransactionLogger:
+    # Trade log for LOG_CHANNEL_ID. log() only puts the entry on a bounded queue, so trades never
+    # wait on Discord; a background task waits up to flush_interval for a burst to build up (or
+    # max_batch entries), then sends them as embed fields packed into as few messages as possible.
+    # Entries that arrive while the queue is full are dropped and counted. close() sends whatever
+    # is still waiting, so a shutdown or restart doesn't lose the last few seconds of trades;
+    # entries logged after that have nothing left to send them and are counted as dropped too.
+    FIELDS_PER_EMBED = 25
+
+    def __init__(self, channel_id, max_queue=1000, flush_interval=5.0, max_batch=50):
+        self.channel_id = channel_id
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.sent = 0
+        self.messages = 0
+        self.dropped = 0
+        self.failed = 0
+        self._task = None
+        self._batch = []  # Taken off the queue but not sent yet
+        self._flushing = None
+        self._closing = False
+        self._closed = False  # Set once close() has taken the last entries off the queue
+
+    def log(self, company_name: str, num_shares: int, share_price: float, total_value: float, user_id: str, transaction_type: str):
+        if self._closed:
+            self.dropped += 1
+            return
+        try:
+            self.queue.put_nowait((company_name, num_shares, share_price, total_value, user_id, transaction_type, datetime.now()))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._closing = self._closed = False
+            self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        # Stop the flusher, let a send already under way finish, then send everything left
+        self._closing = True
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        if self._flushing is not None:
+            await self._flushing
+            self._flushing = None
+        entries, self._batch = self._batch, []
+        while not self.queue.empty():
+            entries.append(self.queue.get_nowait())
+        self._closed = True
+        if entries:
+            await self._flush(entries)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while not self._closing:
+            self._batch.append(await self.queue.get())
+            deadline = loop.time() + self.flush_interval
+            while len(self._batch) < self.max_batch:
+                try:
+                    self._batch.append(await asyncio.wait_for(self.queue.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+            entries, self._batch = self._batch, []
+            # Shielded so close() cancelling the flusher can't cut a send short
+            self._flushing = asyncio.ensure_future(self._flush(entries))
+            await asyncio.shield(self._flushing)
+
+    async def _flush(self, entries):
+        try:
+            await self._send(entries)
+        except Exception as e:
+            # Counted and dropped; an unexpected error must not stop the flusher
+            print(f"Failed to send {len(entries)} transaction log entries: {e!r}")
+            self.failed += len(entries)
+
+    async def _send(self, entries):
+        log_channel = bot.get_channel(self.channel_id)
+        if not log_channel:
+            print(f"Log channel with ID {self.channel_id} not found.")
+            self.failed += len(entries)
+            return
 
-    return buf
+        embeds = []
+        for start in range(0, len(entries), self.FIELDS_PER_EMBED):
+            embed = discord.Embed(title="Transaction Log", color=discord.Color.blue())
+            for company_name, num_shares, share_price, total_value, user_id, transaction_type, logged_at in entries[start:start + self.FIELDS_PER_EMBED]:
+                embed.add_field(
+                    name=f"{transaction_type} - {company_name}",
+                    value=(
+                        f"**User:** <@{user_id}>\n"
+                        f"**Shares:** {num_shares}\n"
+                        f"**Share Price:** {share_price}\n"
+                        f"**Total Value:** {total_value}\n"
+                        f"**Time:** {discord.utils.format_dt(logged_at, 'T')}"
+                    ),
+                    inline=True
+                )
+            embeds.append(embed)
+
+        for page in pack_embeds(embeds):
+            count = sum(len(embed.fields) for embed in page)
+            try:
+                # discord.py waits out the channel's rate limit itself if we hit it
+                await log_channel.send(embeds=page)
+            except Exception as e:
+                print(f"Failed to send {count} transaction log entries: {e!r}")
+                self.failed += count
+                continue
+            self.sent += count
+            self.messages += 1
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "sent": self.sent,
+            "messages": self.messages,
+            "dropped": self.dropped,
+            "failed": self.failed
+        }
+
+transaction_log = TransactionLogger(LOG_CHANNEL_ID)
+
+class DividendScheduler:
+    # Pays dividends when they fall due. Unpaid dividends sit in a min-heap of (due time, dividend_id)
+    # and the task sleeps until the earliest one, or until schedule() wakes it for an earlier one.
+    # A dividend is due at the start of its payout date in UTC, when the database's CURRENT_DATE
+    # reaches it. Heap entries for dividends that were removed or already paid are simply
+    # skipped, because db.pay_dividend only pays what is due and unpaid; one that is still
+    # unpaid when it comes up is tried again after retry_delay.
+    def __init__(self, db, retry_delay=60):
+        self.db = db
+        self.retry_delay = retry_delay
+        self.heap = []
+        self.paid = 0
+        self._wake = asyncio.Event()
+        self._task = None
+
+    async def load(self):
+        # Everything unpaid, including dividends that fell due while the bot was down
+        self.heap = []
+        for dividend_id, payout_date in await self.db.get_unpaid_dividends():
+            try:
+                normalized = normalize_payout_date(payout_date)
+            except ValueError:
+                print(f"Dividend {dividend_id} has an invalid payout date {payout_date!r}, not scheduling it.")
+                continue
+            # Dates posted before they were stored zero-padded would never compare as due
+            if normalized != payout_date:
+                await self.db.set_dividend_payout_date(dividend_id, normalized)
+            self.schedule(dividend_id, normalized)
+
+    def schedule(self, dividend_id, payout_date):
+        due = datetime.fromisoformat(normalize_payout_date(payout_date)).replace(tzinfo=timezone.utc).timestamp()
+        heapq.heappush(self.heap, (due, dividend_id))
+        self._wake.set()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            if not self.heap:
+                await self._wake.wait()
+                continue
+
+            due, dividend_id = self.heap[0]
+            delay = due - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self.heap)
+            try:
+                result = await self.db.pay_dividend(dividend_id)
+                # Not due yet by the database's clock; it must not drop out of the heap
+                if not result and await self.db.is_dividend_unpaid(dividend_id):
+                    heapq.heappush(self.heap, (time.time() + self.retry_delay, dividend_id))
+            except Exception as e:
+                print(f"Failed to pay dividend {dividend_id}, retrying in {self.retry_delay}s: {e}")
+                heapq.heappush(self.heap, (time.time() + self.retry_delay, dividend_id))
+                continue
+            if result:
+                company_name, dividend_per_share, payout_date, total_payout, holders = result
+                self.paid += 1
+                print(f"Paid {company_name} dividend of {dividend_per_share} per share due {payout_date}: {total_payout} to {holders} holders")
+
+dividend_scheduler = DividendScheduler(db)
 
 @bot.tree.command(name="share_price_graph", description="Get a graph of share prices over a specific period.")
-@app_commands.describe(company_name="Graph of the company", period="1h,12h,1d,3d,7d")
-async def share_price_graph(interaction: discord.Interaction, company_name: str, period: str):
+@app_commands.describe(company_name="Graph of the company", period="1h,12h,1d,3d,7d", style="line or candle")
+async def share_price_graph(interaction: discord.Interaction, company_name: str, period: str, style: str = "line"):
     await interaction.response.defer()
     try:
-        price_data = await db.get_share_price_history(company_name, period)
-
-        if not price_data:
+        latest = await db.get_latest_history_row(company_name)
+        if not latest or period not in HISTORY_PERIODS:
             await interaction.followup.send(f"No price history found for {company_name}.", ephemeral=True)
             return
 
-        times, prices = zip(*[(time, price) for date, time, price in price_data])
+        # Any new tick changes the latest row and so the key. The minute is part of it too, as the
+        # graph's window slides forward even when nothing trades.
+        key = (company_name, period, style, latest, int(datetime.now().timestamp()) // 60)
+        png = graph_cache.get(key)
+        if png is None:
+            png = await render_share_price_graph(company_name, period, style)
+            if png is None:
+                await interaction.followup.send(f"No price history found for {company_name}.", ephemeral=True)
+                return
+            graph_cache.put(key, png)
 
-        buf = await generate_graph_in_background(company_name, times, prices, period)
-        file = discord.File(fp=buf, filename=f"{company_name}_price_history.png")
+        file = discord.File(fp=io.BytesIO(png), filename=f"{company_name}_price_history.png")
         await interaction.followup.send(file=file)
 
     except Exception as e:
         await interaction.followup.send(f"An error occurred while generating the graph: {str(e)}", ephemeral=True)
 
-@tasks.loop(minutes=1)
+async def render_share_price_graph(company_name, period, style):
+    if style == "candle":
+        start_time, candles = await db.get_price_candles(company_name, period)
+        resolution = HISTORY_PERIODS[period][1]
+        # Drop the candle before the window that get_price_candles seeds the series with
+        candles = [candle for candle in candles if candle[0] + resolution > start_time]
+        if not candles:
+            return None
+        return await graph_renderer.render(charts.create_and_save_candlestick_graph, company_name, candles, resolution, period)
+
+    price_data = await db.get_share_price_history(company_name, period)
+    if not price_data:
+        return None
+    timestamps, prices = zip(*price_data)
+    return await graph_renderer.render(charts.create_and_save_graph, company_name, list(timestamps), list(prices), period)
+
+@tasks.loop(minutes=PRICE_KEYFRAME_MINUTES)
 async def update_share_prices():
-    # Fetch all companies
-    companies = await db.get_all_companies()
-    
-    # Loop through all companies and record their current prices
-    for company in companies:
-        company_name = company[0]
-        share_price = company[1]
-        current_date = date.today().isoformat()
-        current_time = datetime.now().strftime('%H:%M:%S')
-        await db.store_share_price_history(company_name, current_date, current_time, share_price)
+    # Keyframe every company's current price in one batched write
+    await db.snapshot_share_prices()
+
+@tasks.loop(hours=NATION_SYNC_HOURS)
+async def sync_nations():
+    # Pull names and discord handles for every registered nation into the nations table
+    started = time.perf_counter()
+    try:
+        synced = await nation_cache.sync(await db.get_registered_nation_ids(), batch_size=NATION_SYNC_BATCH)
+    except Exception as e:
+        # Logged and retried on the next run; an exception escaping here would end the loop for good
+        print(f"Nation sync failed: {e!r}")
+        return
+    print(f"Synced {synced} nations in {time.perf_counter() - started:.1f}s")
 
 @bot.tree.command(name="ping", description="-")
 async def ping(interaction: discord.Interaction):
@@ -154,54 +487,44 @@ async def who(interaction: discord.Interaction, nation: str):
             nation_id = int(nation)
         else:
             # Fetch nation by name
-            query = kit.query("nations", {"nation_name": nation}, "id, nation_name")
-            result = query.get()
-            if not result or not result.nations:
+            try:
+                result = await nation_cache.get(nation_name=nation)
+            except PnWError:
+                result = None
+            if not result:
                 await interaction.response.send_message("Failed to fetch nation data by name. Please check the nation name and try again.", ephemeral=True)
                 return
-            nation_id = result.nations[0].id
+            nation_id = result["id"]
+
+        # Look up which Discord user, if any, registered this nation
+        user_id = await db.get_user_data_by_nation_id(nation_id)
 
-    # Fetch the nation information from the Politics and War API using the nation ID
-    query = kit.query("nations", {"id": int(nation_id)}, "id, nation_name")
-    result = query.get()
+    # Fetch the nation information, from the cache when it was looked up recently
+    try:
+        result = await nation_cache.get(nation_id=nation_id)
+    except PnWError:
+        result = None
 
-    if not result or not result.nations:
+    if not result:
         await interaction.response.send_message("Failed to fetch nation data. Please try again later.", ephemeral=True)
         return
 
-    nation_name = result.nations[0].nation_name
+    nation_name = result["nation_name"]
 
-    # Fetch balance and company shares information
-    if await db.get_user_data_by_nation_id(nation_id):
-        balance = round(await db.get_user_credits(await db.get_user_data_by_nation_id(nation_id)),2)
-        companies = await db.get_all_companies()  # Assuming this returns a list of companies
+    # Fetch balance and company shares information in one query
+    portfolio = await db.get_portfolio(user_id) if user_id else None
+    if portfolio:
+        balance = round(portfolio["credits"], 2)
+        total_worth = round(portfolio["total_worth"], 2)
 
         user_shares_info = ""  # This will store all the companies and shares info
-        total_worth = 0  # To store the total worth of shares for all companies
-
-        for company_data in companies:
-            # Extract company name, share price, etc. Assuming company_data is structured like (company_name, share_price, ...)
-            if isinstance(company_data, tuple):
-                company_name = company_data[1]  # Extract the company name
-                share_price = company_data[2]  # Extract the share price
-            else:
-                company_name = str(company_data)
-                share_price = 0  # In case share price is missing, default to 0
-
-            user_shares = await db.get_user_shares(user_id, company_name)
-            
-            # Calculate worth of the user's shares in this company
-            company_worth = user_shares * share_price
-            total_worth = (total_worth) + (company_worth)
-            # Add the company and shares info to the user_shares_info string
-
-            if user_shares > 0:
-                user_shares_info += (
-                    f"🏢 **{company_name}**\n"
-                    f"📊 **Shares Owned**: {user_shares}\n"
-                    f"💰 **Worth**: ${company_worth:,.2f}\n"
-                    f"🔖 **Share Price**: ${share_price:,.2f}\n\n"
-                )
+        for holding in portfolio["holdings"]:
+            user_shares_info += (
+                f"🏢 **{holding['company_name']}**\n"
+                f"📊 **Shares Owned**: {holding['shares']}\n"
+                f"💰 **Worth**: ${holding['worth']:,.2f}\n"
+                f"🔖 **Share Price**: ${holding['share_price']:,.2f}\n\n"
+            )
     else:
         balance = 'Not Registered'
         user_shares_info = 'No shares registered.'
@@ -259,15 +582,20 @@ async def verify_command(interaction: discord.Interaction, nation_id: int):
         return
 
     user = interaction.user.name
-    query = kit.query("nations", {"id": int(nation_id)}, "id, nation_name, discord")
-    result = query.get()
-
-    if not result or not result.nations:
+    try:
+        result = await nation_cache.get(nation_id=nation_id)
+        # The nation's discord may have just been changed to verify, so recheck a mismatch live
+        if result and result["discord"] != user:
+            result = await nation_cache.get(nation_id=nation_id, refresh=True)
+    except PnWError:
+        result = None
+
+    if not result:
         await interaction.response.send_message("Failed to fetch nation data. Please try again later.", ephemeral=True)
         return
 
-    nation_name = result.nations[0].nation_name
-    discord = result.nations[0].discord
+    nation_name = result["nation_name"]
+    discord = result["discord"]
     
     if user == discord:
         # Store nation data in db
@@ -318,24 +646,19 @@ async def register_company(interaction: discord.Interaction, company_name: str,
 @bot.tree.command(name="list_companies", description="List all registered companies.")
 async def list_companies(interaction: discord.Interaction):
     
-    companies = await db.get_all_companies()
+    # Companies with their shares and dividends come back from a single query
+    companies = await db.get_company_listing()
     
     if not companies:
         await interaction.response.send_message("No companies are currently registered.", ephemeral=True)
         return
 
-    # Send the first response with the first company embed or a simple acknowledgment
-    await interaction.response.defer()
-
-    for i, (company_id, company_name, share_price, total_shares, user_id) in enumerate(companies):
-        shares = await db.get_shares(company_name)
-        percent = round((total_shares / shares) * 100, 2) if shares else 0
+    embeds = []
+    for company_id, company_name, share_price, total_shares, user_id, shares, dividends in companies:
+        percent = round((total_shares / shares) * 100, 2) if shares and total_shares is not None else 0
         valuation = round(shares * share_price, 2) if shares else 0
 
-        # Fetch dividend info for the company
-        dividends = await db.get_dividends(company_name)
         dividend_info = ""
-        
         if dividends:
             for dividend_per_share, payout_date in dividends:
                 dividend_info += f"**Dividend**: ${dividend_per_share:,} (Payout Date: {payout_date})\n"
@@ -345,29 +668,35 @@ async def list_companies(interaction: discord.Interaction):
         # Create a new embed for each company
         embed = discord.Embed(title=f"Company ID: {company_id} - Company Name: {company_name}", color=discord.Color.blue())
         embed.add_field(name="Share Price", value=f"<:dollar:1312376430788870194>{share_price:,}", inline=False)
+        vwap = await db.get_vwap(company_name)
+        if vwap is not None:
+            embed.add_field(name="Recent VWAP", value=f"<:dollar:1312376430788870194>{round(vwap, 2):,}", inline=False)
         embed.add_field(name="Registered Shares", value=f"{shares}", inline=True)
         embed.add_field(name="Remaining Shares", value=f"{total_shares} ({percent}%)", inline=True)
         embed.add_field(name="Company Valuation", value=f"${valuation:,}", inline=False)
         embed.add_field(name="Owner", value=f"<@" + str(user_id) + ">", inline=False)
-        embed.add_field(name="Dividends", value=dividend_info, inline=False)
-        
-        # Send the first message using interaction.followup.send
-        if i == 0:
-            await interaction.followup.send(embed=embed)
-        else:
-            await interaction.followup.send(embed=embed)
+        embed.add_field(name="Dividends", value=dividend_info[:1024], inline=False)
+        embeds.append(embed)
+
+    # Up to 10 company embeds per page, flipped through with buttons
+    pages = pack_embeds(embeds)
+
+    async def fetch_page(page):
+        return pages[page]
+
+    await send_paginated(interaction, fetch_page, len(pages))
 
 @bot.tree.command(name="buy_shares", description="Buy shares in a company.")
 @app_commands.describe(company_name="Company name", company_id="Company ID", num_shares="Number of shares you will buy")
 async def buy_shares(interaction: discord.Interaction, company_name: str = None, company_id: str = None, num_shares: int = None):
     user_id = interaction.user.id
     try:
-        # Fetch the company details
+        # Work out which company is being bought from
         if company_name:
-            company = await db.get_company(company_name=company_name)
+            company_id = None
         elif company_id:
             if company_id.isdigit():  # Check if company ID is a valid integer string
-                company = await db.get_company(company_id=int(company_id))
+                company_id = int(company_id)
             else:
                 await interaction.response.send_message("Invalid company ID.", ephemeral=True)
                 return
@@ -375,57 +704,22 @@ async def buy_shares(interaction: discord.Interaction, company_name: str = None,
             await interaction.response.send_message("Please enter either a company name or ID.", ephemeral=True)
             return
 
-        if not company:
-            await interaction.response.send_message("Invalid company ID or name.", ephemeral=True)
-            return
-    
-    
-        company_name, share_price, total_shares, company_owner_id = company
-
         MAX_SHARES_PER_TRANSACTION = 999999999
-        if num_shares > MAX_SHARES_PER_TRANSACTION:
+        if num_shares and num_shares > MAX_SHARES_PER_TRANSACTION:
             await interaction.response.send_message(f"Cannot buy more than {MAX_SHARES_PER_TRANSACTION} shares in a single transaction.", ephemeral=True)
             return
-        
-        if total_shares < num_shares:
-            await interaction.response.send_message(f"Not enough shares available. Available Shares: {total_shares}", ephemeral=True)
-            return
-
-        share_price = round(float(share_price), 2)
-        total_cost = round(num_shares * share_price, 2)
 
-        # Check if the user has enough balance
-        user_balance = await db.get_user_credits(user_id)
-        if user_balance < total_cost:
-            await interaction.response.send_message("You don't have enough coins to buy these shares.", ephemeral=True)
+        # Balance check, share and coin moves, price tick and company update all happen in one transaction
+        try:
+            trade = await db.execute_trade("Buy", user_id, num_shares, company_name=company_name, company_id=company_id)
+        except ValueError as e:
+            await interaction.response.send_message(str(e), ephemeral=True)
             return
 
-        # Update the user's shares and balance
-        await db.update_user_shares(user_id, company_name, num_shares)
-        await db.update_user_credits_after_purchase(user_id, total_cost)
-
-         # Get the current timestamp
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        #insert into Share Price table
-        await db.insert_share_price_history(company_name, share_price, timestamp)
-
-        # Update the company's balance (add to the owner's credits)
-        await db.add_credits(company_owner_id, total_cost)
-
-        # Fetch the average price of the company's shares
-        average_price = await db.get_average_price(company_name)
-        if average_price is None:
-            average_price = await db.get_average_price_all_trades(company_name)
+        # Queue the transaction for the log channel, it is sent in the background
+        transaction_log.log(trade["company_name"], num_shares, trade["share_price"], trade["total_value"], user_id, "Buy")
 
-        #Update the company's details
-        new_price = average_price
-        new_shares = total_shares - num_shares
-        await db.update_company_details(company_name, new_price, new_shares)
-
-        # Log the transaction to a specific Discord channel
-        await log_transaction(company_name, num_shares, share_price, total_cost, user_id, "Buy")
-
-        await interaction.response.send_message(f"Successfully bought {num_shares} shares of {company_name} for {total_cost} coins.")
+        await interaction.response.send_message(f"Successfully bought {num_shares} shares of {trade['company_name']} for {trade['total_value']} coins.")
     
     except Exception as e:
         # Handle any errors that occur during the transaction
@@ -436,49 +730,22 @@ async def buy_shares(interaction: discord.Interaction, company_name: str = None,
 async def sell_shares(interaction: discord.Interaction, company_name: str, num_shares: int):
     user_id = interaction.user.id
 
-    # Fetch the company details
-    company = await db.get_company_D(company_name)
-    if not company:
-        await interaction.response.send_message("Invalid company name.", ephemeral=True)
-        return
-
-    company_name, share_price, total_shares, company_owner_id = company
-    share_price = round(float(share_price), 2)
-
-    # Check if the user has enough shares to sell
-    user_shares = await db.get_user_shares(user_id, company_name)
-    if user_shares is None or user_shares < num_shares:
-        await interaction.response.send_message("You don't have enough shares to sell.", ephemeral=True)
-        return
     MAX_SHARES_PER_TRANSACTION = 0
     if num_shares > MAX_SHARES_PER_TRANSACTION:
         await interaction.response.send_message(f"Cannot sell more than {MAX_SHARES_PER_TRANSACTION} shares in a single transaction.", ephemeral=True)
         return
 
-    # Calculate the total value of the shares being sold
-    total_value = round(num_shares * share_price, 2)
-
-    # Update the user's shares and balance
-    await db.update_user_shares(user_id, company_name, -num_shares)
-    await db.add_credits(user_id, total_value)
-
-    # Update the company's balance (deduct from the owner's credits)
-    await db.update_user_credits_after_purchase(company_owner_id, total_value)
-
-    # Reduce the share price slightly when shares are sold
-    if total_shares == 0:
-        new_price = round(share_price * 0.90, 2)
-    else:
-        new_price = round(share_price * (1 + (num_shares / total_shares) ** 1.1), 2)-share_price
-        new_price = share_price - max(30, new_price)
-
-    new_shares = total_shares + num_shares
-    await db.update_company_details(company_name, new_price, new_shares)
+    # Share and coin moves and the price drop are applied in one transaction
+    try:
+        trade = await db.execute_trade("Sell", user_id, num_shares, company_name=company_name)
+    except ValueError as e:
+        await interaction.response.send_message(str(e), ephemeral=True)
+        return
 
-    # Log the transaction in the specified channel
-    await log_transaction(company_name, -num_shares, share_price, total_value, user_id, "Sell")
+    # Queue the transaction for the log channel, it is sent in the background
+    transaction_log.log(trade["company_name"], -num_shares, trade["share_price"], trade["total_value"], user_id, "Sell")
 
-    await interaction.response.send_message(f"Successfully sold {num_shares} shares of {company_name} for {total_value} coins.")
+    await interaction.response.send_message(f"Successfully sold {num_shares} shares of {trade['company_name']} for {trade['total_value']} coins.")
     
 @bot.tree.command(name="remove_company", description="Remove a company from the database.")
 @app_commands.describe(company_name="The name of the company to remove.")
@@ -491,8 +758,12 @@ async def remove_company_command(interaction: discord.Interaction, company_name:
         await interaction.response.send_message(f"Company {company_name} does not exist.")
         return
 
-    await db.remove_company(company_name)
-    await interaction.response.send_message(f"Company {company_name} and all related data have been removed.")
+    # Cancels the company's open orders and refunds their escrow along with it
+    cancelled = await matching_engine.remove_company(company_name)
+    message = f"Company {company_name} and all related data have been removed."
+    if cancelled:
+        message += f" {len(cancelled)} open orders were cancelled and refunded."
+    await interaction.response.send_message(message)
     
 @bot.tree.command(name="edit_company", description="Edit company details.")
 @app_commands.describe(company_name="Name of the company to edit", new_share_price="New share price", new_total_shares="New total number of shares")
@@ -524,37 +795,43 @@ async def update_registered_shares(interaction: discord.Interaction, company_nam
     await db.add_shares(company_name, shares)
     await interaction.response.send_message('Updated!')
 
-@bot.tree.command(name='market', description="Show all available trades.")
-async def market(interaction: discord.Interaction):
-    trades = await db.get_all_trades()  # Fetch all available trades from the database
+MARKET_PAGE_SIZE = 10
 
-    if not trades:
+@bot.tree.command(name='market', description="Show available trades, cheapest first.")
+@app_commands.describe(company="(Optional) Only show trades for this company")
+async def market(interaction: discord.Interaction, company: str = None):
+    viewer_id = interaction.user.id
+    total = await db.count_market_trades(viewer_id, company)
+
+    if not total:
         await interaction.response.send_message("No trades available.")
         return
 
-    # Create an embed for displaying trades
-    embed = discord.Embed(title="Available Trades", color=discord.Color.blue())
+    # cursors[page] is the (price, trade_id) the page starts after, filled in as pages are shown
+    cursors = [None]
 
-    for trade in trades:
-        # Assuming the tuple is structured as (trade_id, seller_id, company_name, shares_available, price_per_share)
-        trade_id = trade[0]
-        seller_id = str(trade[1])
-        company_name = trade[2]
-        shares_available = trade[3]
-        price_per_share = round(trade[4],2)
+    async def fetch_page(page):
+        trades = await db.get_market_trades(viewer_id, company, after=cursors[page], limit=MARKET_PAGE_SIZE)
+        if trades and len(cursors) == page + 1:
+            cursors.append((trades[-1][4], trades[-1][0]))
 
-        embed.add_field(
-            name=f"Trade ID: {trade_id}",
-            value=(
-                f"**Seller ID:** {'<@' + seller_id + '>'}\n"
+        # Create an embed for displaying trades
+        title = f"Available Trades - {company}" if company else "Available Trades"
+        embed = discord.Embed(title=title, color=discord.Color.blue())
+        for trade_id, seller_id, company_name, shares_available, price_per_share, to_user_id in trades:
+            value = (
+                f"**Seller ID:** {'<@' + str(seller_id) + '>'}\n"
                 f"**Company:** {company_name}\n"
                 f"**Shares Available:** {shares_available}\n"
-                f"**Price per Share:** ${price_per_share:,}"
-            ),
-            inline=False
-        )
+                f"**Price per Share:** ${round(price_per_share, 2):,}"
+            )
+            if to_user_id:
+                value += f"\n**Direct Trade To:** <@{to_user_id}>"
+            embed.add_field(name=f"Trade ID: {trade_id}", value=value, inline=False)
+        return [embed]
 
-    await interaction.response.send_message(embed=embed)
+    page_count = (total + MARKET_PAGE_SIZE - 1) // MARKET_PAGE_SIZE
+    await send_paginated(interaction, fetch_page, page_count)
 
 @bot.tree.command(name="post_trade", description="Post a trade to sell shares on the market")
 @app_commands.describe(company="Company to sell shares from", shares="Number of shares", price="Price per share", to="(Optional) User to send a direct trade to")
@@ -582,69 +859,115 @@ async def post_trade(interaction: discord.Interaction, company: str, shares: int
 @app_commands.describe(trade_id="ID of the trade to buy", num_shares="Number of shares to buy")
 async def buy_trade(interaction: discord.Interaction, trade_id: int, num_shares: int):
     buyer_id = interaction.user.id
-    
-    # Get the trade details from the database
-    trade = await db.get_trade(trade_id)
-    if not trade:
-        await interaction.response.send_message("Trade not found. Please check the trade ID.", ephemeral=True)
+
+    # Credit and share transfer, trade update and company price update happen in one transaction
+    try:
+        trade = await db.execute_trade("Market", buyer_id, num_shares, trade_id=trade_id)
+    except ValueError as e:
+        await interaction.response.send_message(str(e), ephemeral=True)
         return
-    
-    company_name = trade['company_name']
-    shares_available = trade['shares_available']
-    price_per_share = trade['price_per_share']
-    seller_id = trade['seller_id']
-    to_user_id = trade['to_user_id']  # New field to specify the direct trade recipient
 
-    # If the trade is restricted to a specific user, check if the buyer is that user
-    if to_user_id and buyer_id != to_user_id:
-        await interaction.response.send_message(f"This trade is only available to <@{to_user_id}>.", ephemeral=True)
+    await interaction.response.send_message(f"Successfully bought {num_shares} shares of {trade['company_name']} from <@{trade['seller_id']}> for ${trade['total_value']:,}.")
+
+@bot.tree.command(name="place_order", description="Place a limit order to buy (bid) or sell (ask) shares")
+@app_commands.describe(side="Bid to buy or ask to sell", company="Company to trade", shares="Number of shares", price="Limit price per share")
+@app_commands.choices(side=[
+    app_commands.Choice(name="Bid (buy)", value="bid"),
+    app_commands.Choice(name="Ask (sell)", value="ask"),
+])
+async def place_order(interaction: discord.Interaction, side: str, company: str, shares: int, price: float):
+    user_id = interaction.user.id
+
+    # Matches against the book at the resting orders' prices; escrow, fills and the price update
+    # are settled in one transaction
+    try:
+        order, fills = await matching_engine.place(user_id, company, side, price, shares)
+    except ValueError as e:
+        await interaction.response.send_message(str(e), ephemeral=True)
+        return
+
+    action = "Bought" if side == "bid" else "Sold"
+    lines = [f"Order #{order.order_id}: {'Buy' if side == 'bid' else 'Sell'} {shares} shares of {company} at ${order.price:,}."]
+    if fills:
+        filled = sum(fill for _, fill in fills)
+        value = round(sum(maker.price * fill for maker, fill in fills), 2)
+        lines.append(f"{action} {filled} shares for ${value:,} (average ${round(value / filled, 2):,} per share).")
+    if order.remaining:
+        lines.append(f"{order.remaining} shares are resting on the book. Cancel with `/cancel_order {order.order_id}`.")
+    await interaction.response.send_message("\n".join(lines))
+
+@bot.tree.command(name="cancel_order", description="Cancel one of your open orders")
+@app_commands.describe(order_id="ID of the order to cancel")
+async def cancel_order(interaction: discord.Interaction, order_id: int):
+    try:
+        company_name, side, price, remaining = await matching_engine.cancel(interaction.user.id, order_id)
+    except ValueError as e:
+        await interaction.response.send_message(str(e), ephemeral=True)
         return
 
-    # insert share price table
-    await db.insert_share_price_history(company_name, price_per_share, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    released = f"{remaining} shares" if side == "ask" else f"${round(price * remaining, 2):,}"
+    await interaction.response.send_message(f"Order #{order_id} for {company_name} cancelled, {released} returned to you.", ephemeral=True)
 
-    # Check if the requested number of shares is available
-    if num_shares > shares_available:
-        await interaction.response.send_message(f"Not enough shares available. Only {shares_available} shares are left.", ephemeral=True)
+@bot.tree.command(name="order_book", description="Show the open bids and asks for a company")
+@app_commands.describe(company="Company name")
+async def order_book(interaction: discord.Interaction, company: str):
+    book = matching_engine.books.get(company)
+    if not book or not book.orders:
+        await interaction.response.send_message(f"There are no open orders for {company}.")
         return
 
-    total_cost = num_shares * price_per_share
+    embed = discord.Embed(title=f"Order Book - {company}", color=discord.Color.blue())
+    for side, name in (("ask", "Asks"), ("bid", "Bids")):
+        levels = book.levels(side)
+        value = "\n".join(f"${price:,} - {shares:,} shares ({count} orders)" for price, shares, count in levels)
+        embed.add_field(name=name, value=value or "None", inline=True)
+
+    best_bid, best_ask = book.best("bid"), book.best("ask")
+    if best_bid and best_ask:
+        embed.set_footer(text=f"Spread: ${round(best_ask.price - best_bid.price, 2):,}")
+    await interaction.response.send_message(embed=embed)
 
-    # Check if the buyer has enough credits
-    buyer_credits = await db.get_user_credits(buyer_id)
-    if buyer_credits < total_cost:
-        await interaction.response.send_message(f"You don't have enough credits to buy {num_shares} shares of {company_name}. Total cost is ${total_cost:,}.")
+HISTORY_PAGE_SIZE = 10
+
+@bot.tree.command(name="history", description="Show your trade history, newest first.")
+@app_commands.describe(company="(Optional) Only show trades in this company", days="(Optional) Only show the last this many days", user="(Admin only) Show another user's history")
+async def history(interaction: discord.Interaction, company: str = None, days: int = None, user: discord.User = None):
+    target = user or interaction.user
+    if target.id != interaction.user.id and not any(role.id == AUTHORIZED_ROLE_ID for role in interaction.user.roles):
+        await interaction.response.send_message("You do not have permission to view other users' history.", ephemeral=True)
         return
-    
-    # Transfer credits and shares
-    await db.add_credits(buyer_id, -total_cost)
-    await db.add_credits(seller_id, total_cost)
-    await db.update_user_shares(seller_id, company_name, -num_shares)
-    await db.update_user_shares(buyer_id, company_name, num_shares)
-    # Update or remove the trade from the market
-    remaining_shares = shares_available - num_shares
-    if remaining_shares > 0:
-        # Update the trade to reflect the new number of available shares
-        await db.update_trade(trade_id, remaining_shares)
-    else:
-        # Remove the trade from the market if no shares are left
-        await db.delete_trade(trade_id)
 
-    await interaction.response.send_message(f"Successfully bought {num_shares} shares of {company_name} from <@{seller_id}> for ${total_cost:,}.")
+    since = int((datetime.now() - timedelta(days=days)).timestamp()) if days else None
+    total = await db.count_transactions(target.id, company, since)
+    if not total:
+        await interaction.response.send_message("No trades found.", ephemeral=True)
+        return
 
-    # Fetch the company details
-    company = await db.get_company(company_name)
-    company_name, share_price, total_shares, company_owner_id = company
-    
-    # Fetch the average price of the company's shares
-    average_price = await db.get_average_price(company_name)
-    if average_price is None:
-        average_price = await db.get_average_price_all_trades(company_name)
-    
-    #Update the company's details
-    new_price = average_price
-    new_shares = total_shares
-    await db.update_company_details(company_name, new_price, new_shares)
+    # cursors[page] is the (created_at, transaction_id) the page starts before
+    cursors = [None]
+
+    async def fetch_page(page):
+        rows = await db.get_transactions(target.id, company, since, before=cursors[page], limit=HISTORY_PAGE_SIZE)
+        if rows and len(cursors) == page + 1:
+            cursors.append((rows[-1][1], rows[-1][0]))
+
+        embed = discord.Embed(title=f"Trade History - {target.display_name}", color=discord.Color.blue())
+        for transaction_id, created_at, counterparty_id, company_name, side, kind, shares, price, total_value, reference_id in rows:
+            source = {"company": "Company", "market": f"Market trade #{reference_id}", "order": f"Order #{reference_id}"}[kind]
+            embed.add_field(
+                name=f"{'Bought' if side == 'buy' else 'Sold'} {shares:,} {company_name}",
+                value=(
+                    f"**Price:** ${price:,} per share (${total_value:,})\n"
+                    f"**{'Seller' if side == 'buy' else 'Buyer'}:** <@{counterparty_id}>\n"
+                    f"**Via:** {source}\n"
+                    f"**When:** <t:{created_at}:f>"
+                ),
+                inline=False
+            )
+        return [embed]
+
+    page_count = (total + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE
+    await send_paginated(interaction, fetch_page, page_count, ephemeral=True)
 
 @bot.tree.command(name="post_dividend", description="Post a dividend payout for a company")
 @app_commands.describe(company="Company to post dividends for", dividend="Dividend amount per share", payout_date="Payout date (YYYY-MM-DD)")
@@ -654,8 +977,15 @@ async def post_dividend(interaction: discord.Interaction, company: str, dividend
         await interaction.response.send_message("You do not have permissions to post dividends.", ephemeral=True)
         return
     
-    # Insert dividend into the dividends table using the database method
-    await db.post_dividend(company, dividend, payout_date)
+    try:
+        payout_date = normalize_payout_date(payout_date)
+    except ValueError:
+        await interaction.response.send_message("Payout date must be in YYYY-MM-DD format.", ephemeral=True)
+        return
+
+    # Insert dividend into the dividends table and have it paid out automatically when due
+    dividend_id = await db.post_dividend(company, dividend, payout_date)
+    dividend_scheduler.schedule(dividend_id, payout_date)
     
     await interaction.response.send_message(f"Dividend posted: ${dividend:.2f} per share for {company}, to be paid on {payout_date}.", ephemeral=True)
 
@@ -665,24 +995,18 @@ async def distribute_dividends(interaction: discord.Interaction, company: str):
         await interaction.response.send_message("You do not have permissions to distribute dividends.", ephemeral=True)
         return
 
-    # Get dividends due for the specified company
-    due_dividends = await db.get_due_dividends(company)
+    # Pay every due dividend of the company now instead of waiting for the scheduler
+    paid = await db.distribute_dividends(company)
 
-    if not due_dividends:
+    if not paid:
         await interaction.response.send_message(f"No dividends due for {company} to distribute.", ephemeral=True)
         return
 
-    # Distribute dividends
-    for dividend in due_dividends:
-        # Safely unpack the dividend values
-        dividend_per_share, payout_date = dividend[:2]
-
-        await db.distribute_dividends(company)  # This should handle the distribution logic
-        await interaction.response.send_message(f"Dividends per share {dividend_per_share}, date: {payout_date}.", ephemeral=True)
-        # After distributing, delete the dividend record
-        await db.delete_dividend(company, payout_date)
-
-    await interaction.response.send_message(f"Dividends distributed for {company}.", ephemeral=True)
+    lines = [
+        f"${dividend_per_share:,} per share due {payout_date}: ${total_payout:,} paid to {holders} holders"
+        for dividend_per_share, payout_date, total_payout, holders in paid
+    ]
+    await interaction.response.send_message(f"Dividends distributed for {company}:\n" + "\n".join(lines), ephemeral=True)
 
 @bot.tree.command(name="remove_dividend", description="Remove a dividend payout for a company")
 @app_commands.describe(company="Company to remove dividends from", payout_date="Payout date (YYYY-MM-DD)")
@@ -692,6 +1016,12 @@ async def remove_dividend(interaction: discord.Interaction, company: str, payout
         await interaction.response.send_message("You do not have permissions to remove dividends.", ephemeral=True)
         return
 
+    try:
+        payout_date = normalize_payout_date(payout_date)
+    except ValueError:
+        await interaction.response.send_message("Payout date must be in YYYY-MM-DD format.", ephemeral=True)
+        return
+
     # Remove the dividend from the database
     await db.delete_dividend(company, payout_date)
 
@@ -715,6 +1045,58 @@ async def change_company_owner(interaction: discord.Interaction, company: str, n
 
     await interaction.response.send_message(f"The owner of '{company}' has been changed to <@{new_owner}>.", ephemeral=True)
 
+@bot.tree.command(name="stats", description="Show bot cache statistics.")
+async def stats(interaction: discord.Interaction):
+    if not any(role.id == AUTHORIZED_ROLE_ID for role in interaction.user.roles):
+        await interaction.response.send_message("You do not have permission to view stats.", ephemeral=True)
+        return
+
+    cache_stats = graph_cache.stats()
+    renderer_stats = graph_renderer.stats()
+    nation_stats = nation_cache.stats()
+    log_stats = transaction_log.stats()
+    embed = discord.Embed(title="Bot Stats", color=discord.Color.blue())
+    embed.add_field(
+        name="Graph Cache",
+        value=(
+            f"**Hits:** {cache_stats['hits']}\n"
+            f"**Misses:** {cache_stats['misses']}\n"
+            f"**Evictions:** {cache_stats['evictions']}\n"
+            f"**Entries:** {cache_stats['entries']} ({cache_stats['bytes'] / 1024:,.0f} KiB)"
+        ),
+        inline=False
+    )
+    embed.add_field(
+        name="Graph Renderer",
+        value=(
+            f"**Workers:** {renderer_stats['workers']}\n"
+            f"**In Flight:** {renderer_stats['pending']}\n"
+            f"**Turned Away:** {renderer_stats['rejected']}"
+        ),
+        inline=False
+    )
+    embed.add_field(
+        name="Nation Cache",
+        value=(
+            f"**Memory Hits:** {nation_stats['hits']}\n"
+            f"**Database Hits:** {nation_stats['db_hits']}\n"
+            f"**API Lookups:** {nation_stats['misses']}\n"
+            f"**Entries:** {nation_stats['entries']}"
+        ),
+        inline=False
+    )
+    embed.add_field(
+        name="Transaction Log",
+        value=(
+            f"**Queued:** {log_stats['queued']}\n"
+            f"**Sent:** {log_stats['sent']} in {log_stats['messages']} messages\n"
+            f"**Dropped:** {log_stats['dropped']}\n"
+            f"**Failed:** {log_stats['failed']}"
+        ),
+        inline=False
+    )
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
 @bot.tree.command(name="test")
 async def test(interaction: discord.Interaction):
     await interaction.response.send_message("Test command executed.", ephemeral=True)
@@ -768,6 +1150,55 @@ async def delete_trade(interaction: discord.Interaction, trade_id: int):
     except ValueError as e:
         await interaction.response.send_message(str(e))
 
+SHAREHOLDERS_PAGE_SIZE = 20
+
+class UserNameCache:
+    # Bounded LRU of names of users looked up over REST, so a user is only fetched once per ttl
+    # seconds and a rename is picked up after that
+    def __init__(self, ttl=3600, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # user_id -> (expires at, name)
+
+    def get(self, user_id):
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return None
+        expires, name = entry
+        if expires < time.monotonic():
+            del self.entries[user_id]
+            return None
+        self.entries.move_to_end(user_id)
+        return name
+
+    def put(self, user_id, name):
+        self.entries.pop(user_id, None)
+        self.entries[user_id] = (time.monotonic() + self.ttl, name)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+fetched_user_names = UserNameCache()
+
+async def resolve_user_names(guild, user_ids):
+    # user_id -> display name, from the guild's member cache or the bot's user cache where
+    # possible; whoever is left is fetched concurrently rather than one request at a time
+    names = {}
+    missing = []
+    for user_id in user_ids:
+        user = (guild.get_member(user_id) if guild else None) or bot.get_user(user_id)
+        name = user.display_name if user else fetched_user_names.get(user_id)
+        if name is not None:
+            names[user_id] = name
+        else:
+            missing.append(user_id)
+
+    results = await asyncio.gather(*(bot.fetch_user(user_id) for user_id in missing), return_exceptions=True)
+    for user_id, user in zip(missing, results):
+        if isinstance(user, discord.User):
+            names[user_id] = user.name
+            fetched_user_names.put(user_id, user.name)
+    return names
+
 @bot.tree.command(name="shareholders_info", description="Get the shareholders of a company")
 @app_commands.describe(company_name="Company name", company_id="Company ID")
 async def shareholders(interaction: discord.Interaction, company_name: str = None, company_id: str = None):
@@ -791,18 +1222,25 @@ async def shareholders(interaction: discord.Interaction, company_name: str = Non
 
         company_name, share_price, total_shares, company_owner_id = company
 
-        # Get the shareholders
-        shareholders = await db.get_shareholders(company_name)
+        total = await db.count_shareholders(company_name)
+        if not total:
+            await interaction.response.send_message(f"{company_name} has no shareholders.")
+            return
+
+        async def fetch_page(page):
+            # Holders come sorted by shares with their percentage already worked out
+            shareholders = await db.get_top_shareholders(company_name, SHAREHOLDERS_PAGE_SIZE, page * SHAREHOLDERS_PAGE_SIZE)
+            names = await resolve_user_names(interaction.guild, [int(user_id) for user_id, _, _ in shareholders])
 
-        # Create an embed to display the shareholders
-        embed = discord.Embed(title=f"Shareholders of {company_name}", color=discord.Color.blue())
-        for shareholder in shareholders:
-            user_id = shareholder[0]
-            user = await interaction.client.fetch_user(user_id)
-            shares = shareholder[2]
-            embed.add_field(name=f"{user.name} (<@{user_id}>)", value=f"Shares: {shares}", inline=False)
+            # Create an embed to display the shareholders
+            embed = discord.Embed(title=f"Shareholders of {company_name}", color=discord.Color.blue())
+            for rank, (user_id, shares, percent) in enumerate(shareholders, start=page * SHAREHOLDERS_PAGE_SIZE + 1):
+                share_text = f"Shares: {shares:,}" + (f" ({percent:.2f}%)" if percent is not None else "")
+                embed.add_field(name=f"{rank}. {names.get(int(user_id), 'Unknown user')}", value=f"<@{user_id}>\n{share_text}", inline=False)
+            return [embed]
 
-        await interaction.response.send_message(embed=embed)
+        page_count = (total + SHAREHOLDERS_PAGE_SIZE - 1) // SHAREHOLDERS_PAGE_SIZE
+        await send_paginated(interaction, fetch_page, page_count)
     except Exception as e:
         print(f"Error: {e}")
         await interaction.response.send_message(f"An error occurred.{e}", ephemeral=True)
@@ -813,6 +1251,42 @@ async def restart(interaction: discord.Interaction):
         await interaction.response.send_message("You do not have permission to restart the bot.", ephemeral=True)
         return
     await interaction.response.send_message("Restarting the bot...")
+    # Send the queued trade logs, then flush WAL and release the pooled connections before
+    # replacing the process
+    await transaction_log.close()
+    await db.close()
+    graph_renderer.close()
+    await pnw.close()
     os.execv(sys.executable, [sys.executable] + sys.argv)
 
-bot.run(TOKEN)
\ No newline at end of file
+async def main():
+    discord.utils.setup_logging()
+    try:
+        started = time.perf_counter()
+        await db.init_db()
+        startup_timings["init_db"] = time.perf_counter() - started
+        started = time.perf_counter()
+        await matching_engine.load()
+        await dividend_scheduler.load()
+        startup_timings["state"] = time.perf_counter() - started
+
+        # The graph workers spawn and warm up in the background while the bot connects
+        asyncio.ensure_future(graph_renderer.start())
+        async with bot:
+            try:
+                await bot.start(TOKEN)
+            finally:
+                # Send the queued trade logs while the bot can still reach Discord
+                await transaction_log.close()
+    finally:
+        # Close the database pool, the graph workers and the API session on shutdown
+        dividend_scheduler.stop()
+        await db.close()
+        graph_renderer.close()
+        await pnw.close()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
\ No newline at end of file
@@ -0,0 +1,195 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import io
+import multiprocessing
+import sys
+from datetime import datetime
+
+# numpy and matplotlib are only imported inside the render functions, so importing this module
+# from the bot stays cheap; they get loaded once per worker process by warm_up()
+
+class GraphRenderer:
+    # Long-lived pool of render processes. Renders take plain lists in and give PNG bytes back,
+    # and at most max_pending renders are in flight at once; past that requests are turned away
+    # instead of queueing up behind each other.
+    def __init__(self, workers=2, max_pending=8):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+        self._pool = None
+        self._starting = None
+
+    async def start(self):
+        # Safe to call from several places at once: they all wait on the same warm-up
+        if self._pool is not None:
+            return
+        if self._starting is None:
+            self._starting = asyncio.ensure_future(self._start())
+        try:
+            await asyncio.shield(self._starting)
+        finally:
+            if self._starting is not None and self._starting.done():
+                self._starting = None
+
+    async def _start(self):
+        pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=warm_up
+        )
+        # Get every worker spawned and warmed before the first real request. Each submit spawns
+        # its worker right away, so all of them start while this module stands in as __main__.
+        loop = asyncio.get_running_loop()
+        with worker_main():
+            warming = [loop.run_in_executor(pool, ready) for _ in range(self.workers)]
+        await asyncio.gather(*warming)
+        self._pool = pool
+
+    def close(self):
+        if self._pool is None:
+            return
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self._pool = None
+
+    async def render(self, render, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise RuntimeError("Too many graphs are being drawn right now, please try again in a moment.")
+
+        self.pending += 1
+        try:
+            await self.start()
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._pool, render, *args)
+        except concurrent.futures.process.BrokenProcessPool:
+            # A worker died; start a fresh pool on the next request
+            self.close()
+            raise
+        finally:
+            self.pending -= 1
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            "rejected": self.rejected
+        }
+
+@contextlib.contextmanager
+def worker_main():
+    # spawn re-runs the parent's __main__ in every new process, which would be the whole bot
+    # script: its env checks, client, database and commands. Workers are started with this
+    # module as __main__ instead, so all they import is this file.
+    main = sys.modules["__main__"]
+    sys.modules["__main__"] = sys.modules[__name__]
+    try:
+        yield
+    finally:
+        sys.modules["__main__"] = main
+
+def warm_up():
+    # Runs once in each worker: import the plotting stack, then draw and save a throwaway figure
+    # so the font cache and the Agg backend are loaded before the first real graph
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(1, 1))
+    ax = fig.add_subplot()
+    ax.plot([0, 1], [0, 1])
+    ax.set_title("warm up")
+    fig.savefig(io.BytesIO(), format='png')
+
+def ready():
+    return True
+
+def step_series(timestamps, prices):
+    # (ts, price) change points to a step line: the price holds flat until the next tick
+    import numpy as np
+    import matplotlib.dates as mdates
+
+    times = mdates.date2num([datetime.fromtimestamp(ts) for ts in timestamps])
+    x = np.repeat(times, 2)[1:]
+    y = np.repeat(np.asarray(prices, dtype=float), 2)[:-1]
+    return x, y
+
+def new_graph_figure(company_name, period):
+    # Object-oriented figure, no pyplot global state involved
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(10, 5))
+    ax = fig.add_subplot()
+    ax.set_title(f"Share Price History for {company_name} ({period})")
+    ax.set_xlabel('Time')
+    ax.set_ylabel('Share Price')
+    ax.grid(True)
+    return fig, ax
+
+def save_graph_figure(fig, ax, period):
+    import matplotlib.dates as mdates
+
+    # Adjust the x-axis to show only key time points, not cluttered data
+    ax.xaxis_date()
+    if period in ['1h', '12h']:
+        ax.xaxis.set_major_locator(mdates.AutoDateLocator(maxticks=10))  # Adjust for shorter periods
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
+    else:
+        ax.xaxis.set_major_locator(mdates.AutoDateLocator(maxticks=6))  # Adjust for longer periods
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%m-%d %H:%M'))
+    ax.tick_params(axis='x', labelrotation=45)
+    fig.tight_layout()
+
+    # Render the plot to PNG bytes
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png')
+    return buf.getvalue()
+
+def create_and_save_graph(company_name, timestamps, prices, period):
+    import numpy as np
+    from matplotlib.collections import LineCollection
+
+    fig, ax = new_graph_figure(company_name, period)
+
+    # Build every segment at once and draw one collection per direction colour
+    x, y = step_series(timestamps, prices)
+    points = np.column_stack([x, y])
+    segments = np.stack([points[:-1], points[1:]], axis=1)
+    change = np.diff(y)
+    for mask, colour in ((change > 0, 'green'), (change < 0, 'red'), (change == 0, 'grey')):
+        if mask.any():
+            ax.add_collection(LineCollection(segments[mask], colors=colour, linewidths=2))
+
+    ax.autoscale_view()
+    return save_graph_figure(fig, ax, period)
+
+def create_and_save_candlestick_graph(company_name, candles, resolution, period):
+    # candles are (bucket, open, high, low, close) rows, bucket being the candle's start in epoch seconds
+    import numpy as np
+    import matplotlib.dates as mdates
+    from matplotlib.collections import LineCollection, PolyCollection
+
+    fig, ax = new_graph_figure(company_name, period)
+
+    data = np.asarray([candle[:5] for candle in candles], dtype=float)
+    buckets, opens, highs, lows, closes = data.T
+    x = mdates.date2num([datetime.fromtimestamp(bucket + resolution / 2) for bucket in buckets])
+    half_width = resolution / 86400 * 0.4  # Candle bodies fill 80% of their slot, in days
+    colours = np.where(closes >= opens, 'green', 'red')
+
+    # One collection for the wicks, one for the bodies
+    wicks = np.stack([np.column_stack([x, lows]), np.column_stack([x, highs])], axis=1)
+    ax.add_collection(LineCollection(wicks, colors=colours, linewidths=1))
+    bottoms = np.minimum(opens, closes)
+    tops = np.maximum(opens, closes)
+    bodies = np.stack([
+        np.column_stack([x - half_width, bottoms]),
+        np.column_stack([x - half_width, tops]),
+        np.column_stack([x + half_width, tops]),
+        np.column_stack([x + half_width, bottoms]),
+    ], axis=1)
+    ax.add_collection(PolyCollection(bodies, facecolors=colours, edgecolors=colours))
+
+    ax.autoscale_view()
+    return save_graph_figure(fig, ax, period)
@@ -1,12 +1,345 @@
 import aiosqlite
+import asyncio
+import contextlib
 import datetime
+import json
+
+from pricing import PriceTracker
+
+# Applied to every pooled connection when it is opened
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -8000",
+    "PRAGMA mmap_size = 134217728",
+)
+
+async def _backfill_history_timestamps(db):
+    # Fills ts for the history rows written before schema version 3. date and time were stored
+    # in the bot's local time.
+    cursor = await db.execute("""
+        UPDATE share_price_history
+        SET ts = CAST(strftime('%s', date || ' ' || time, 'utc') AS INTEGER)
+        WHERE ts IS NULL
+    """)
+    updated = cursor.rowcount
+    # A row whose date or time doesn't parse can never be graphed, and one repeating an earlier
+    # row's (company_name, ts), e.g. in the repeated hour when clocks go back, can't be kept
+    # under the unique index version 4 adds
+    cursor = await db.execute("DELETE FROM share_price_history WHERE ts IS NULL")
+    unparseable = cursor.rowcount
+    cursor = await db.execute("""
+        DELETE FROM share_price_history WHERE id NOT IN (
+            SELECT MIN(id) FROM share_price_history GROUP BY company_name, ts
+        )
+    """)
+    duplicates = cursor.rowcount
+    print(f"Backfilled timestamps for {updated} share price history rows")
+    if unparseable or duplicates:
+        print(f"Dropped {unparseable} share price history rows with an unparseable date or time "
+              f"and {duplicates} repeating an earlier timestamp")
+
+# Schema migrations, applied in order on top of the tables created in init_db.
+# The version reached is kept in PRAGMA user_version; each entry is (version, steps) and runs
+# in its own transaction, so an existing user.db only gets the steps it is missing. A step is
+# a SQL statement or an async function taking the connection, for changes SQL alone can't make.
+MIGRATIONS = (
+    # Secondary indexes on the hot lookup paths
+    (1, (
+        "CREATE INDEX IF NOT EXISTS idx_share_price_history_company_date_time ON share_price_history (company_name, date, time)",
+        "CREATE INDEX IF NOT EXISTS idx_share_price_company_timestamp ON share_price (company_name, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_users_nation_id ON users (nation_id)",
+        "CREATE INDEX IF NOT EXISTS idx_trades_company_name ON trades (company_name)",
+        "CREATE INDEX IF NOT EXISTS idx_dividends_company_payout_date ON dividends (company_name, payout_date)",
+    )),
+    # Constraints: one history row per company per sample, numeric prices, no negative holdings
+    (2, (
+        "DELETE FROM share_price_history WHERE typeof(share_price) NOT IN ('real', 'integer')",
+        """DELETE FROM share_price_history WHERE id NOT IN (
+            SELECT MIN(id) FROM share_price_history GROUP BY company_name, date, time
+        )""",
+        "DROP INDEX IF EXISTS idx_share_price_history_company_date_time",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_share_price_history_company_date_time ON share_price_history (company_name, date, time)",
+        """CREATE TRIGGER IF NOT EXISTS share_price_history_numeric_price
+        BEFORE INSERT ON share_price_history
+        WHEN typeof(NEW.share_price) NOT IN ('real', 'integer')
+        BEGIN
+            SELECT RAISE(ABORT, 'share_price must be a number');
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS user_shares_not_negative_insert
+        BEFORE INSERT ON user_shares
+        WHEN NEW.shares < 0
+        BEGIN
+            SELECT RAISE(ABORT, 'User cannot have negative shares.');
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS user_shares_not_negative_update
+        BEFORE UPDATE OF shares ON user_shares
+        WHEN NEW.shares < 0
+        BEGIN
+            SELECT RAISE(ABORT, 'User cannot have negative shares.');
+        END""",
+    )),
+    # Integer epoch timestamps for history so range scans can use an index
+    (3, (
+        "ALTER TABLE share_price_history ADD COLUMN ts INTEGER",
+        _backfill_history_timestamps,
+        "CREATE INDEX IF NOT EXISTS idx_share_price_history_company_ts ON share_price_history (company_name, ts)",
+    )),
+    # One history row per company per timestamp, so snapshots can rely on ON CONFLICT DO NOTHING
+    (4, (
+        """DELETE FROM share_price_history WHERE ts IS NOT NULL AND id NOT IN (
+            SELECT MIN(id) FROM share_price_history WHERE ts IS NOT NULL GROUP BY company_name, ts
+        )""",
+        "DROP INDEX IF EXISTS idx_share_price_history_company_ts",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_share_price_history_company_ts ON share_price_history (company_name, ts)",
+    )),
+    # (company_name, ts) is the only key history needs now, and price ticks upsert on it
+    (5, (
+        "DROP INDEX IF EXISTS idx_share_price_history_company_date_time",
+    )),
+    # 5 minute, 1 hour and 1 day OHLC candles, seeded from history and then kept up to date
+    # by triggers on every insert (and on the ts backfill / same-second tick updates)
+    (6, (
+        """CREATE TABLE IF NOT EXISTS price_candles (
+            company_name TEXT NOT NULL,
+            resolution INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            open REAL NOT NULL,
+            high REAL NOT NULL,
+            low REAL NOT NULL,
+            close REAL NOT NULL,
+            open_ts INTEGER NOT NULL,
+            close_ts INTEGER NOT NULL,
+            PRIMARY KEY (company_name, resolution, bucket)
+        ) WITHOUT ROWID""",
+        """INSERT OR REPLACE INTO price_candles (company_name, resolution, bucket, open, high, low, close, open_ts, close_ts)
+        SELECT company_name, resolution, bucket,
+               first_value(share_price) OVER w, max(share_price) OVER w, min(share_price) OVER w,
+               last_value(share_price) OVER w, min(ts) OVER w, max(ts) OVER w
+        FROM (
+            SELECT h.company_name, r.column1 AS resolution, h.ts - h.ts % r.column1 AS bucket, h.ts, h.share_price
+            FROM share_price_history h, (VALUES (300), (3600), (86400)) r
+            WHERE h.ts IS NOT NULL
+        )
+        WINDOW w AS (PARTITION BY company_name, resolution, bucket ORDER BY ts
+                     ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING)""",
+        """CREATE TRIGGER IF NOT EXISTS share_price_history_candles_insert
+        AFTER INSERT ON share_price_history
+        WHEN NEW.ts IS NOT NULL
+        BEGIN
+        INSERT INTO price_candles (company_name, resolution, bucket, open, high, low, close, open_ts, close_ts)
+        SELECT NEW.company_name, r.column1, NEW.ts - NEW.ts % r.column1,
+               NEW.share_price, NEW.share_price, NEW.share_price, NEW.share_price, NEW.ts, NEW.ts
+        FROM (VALUES (300), (3600), (86400)) r
+        WHERE true
+        ON CONFLICT(company_name, resolution, bucket) DO UPDATE SET
+            high = max(high, excluded.high),
+            low = min(low, excluded.low),
+            open = CASE WHEN excluded.open_ts < open_ts THEN excluded.open ELSE open END,
+            open_ts = min(open_ts, excluded.open_ts),
+            close = CASE WHEN excluded.close_ts >= close_ts THEN excluded.close ELSE close END,
+            close_ts = max(close_ts, excluded.close_ts);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS share_price_history_candles_update
+        AFTER UPDATE OF ts, share_price ON share_price_history
+        WHEN NEW.ts IS NOT NULL
+        BEGIN
+        INSERT INTO price_candles (company_name, resolution, bucket, open, high, low, close, open_ts, close_ts)
+        SELECT NEW.company_name, r.column1, NEW.ts - NEW.ts % r.column1,
+               NEW.share_price, NEW.share_price, NEW.share_price, NEW.share_price, NEW.ts, NEW.ts
+        FROM (VALUES (300), (3600), (86400)) r
+        WHERE true
+        ON CONFLICT(company_name, resolution, bucket) DO UPDATE SET
+            high = max(high, excluded.high),
+            low = min(low, excluded.low),
+            open = CASE WHEN excluded.open_ts < open_ts THEN excluded.open ELSE open END,
+            open_ts = min(open_ts, excluded.open_ts),
+            close = CASE WHEN excluded.close_ts >= close_ts THEN excluded.close ELSE close END,
+            close_ts = max(close_ts, excluded.close_ts);
+        END""",
+    )),
+    # Small key/value store for bot state that has to survive restarts
+    (7, (
+        """CREATE TABLE IF NOT EXISTS bot_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )""",
+    )),
+    # Order book reads: cheapest first, overall or per company
+    (8, (
+        "DROP INDEX IF EXISTS idx_trades_company_name",
+        "CREATE INDEX IF NOT EXISTS idx_trades_company_price ON trades (company_name, price_per_share, trade_id)",
+        "CREATE INDEX IF NOT EXISTS idx_trades_price ON trades (price_per_share, trade_id)",
+    )),
+    # Limit orders for the matching engine. Open orders hold their escrow (coins for bids,
+    # shares for asks) until they fill or are cancelled.
+    (9, (
+        """CREATE TABLE IF NOT EXISTS orders (
+            order_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            company_name TEXT NOT NULL,
+            side TEXT NOT NULL CHECK (side IN ('bid', 'ask')),
+            price REAL NOT NULL CHECK (price > 0),
+            shares INTEGER NOT NULL CHECK (shares > 0),
+            remaining INTEGER NOT NULL CHECK (remaining >= 0),
+            status TEXT NOT NULL DEFAULT 'open' CHECK (status IN ('open', 'filled', 'cancelled')),
+            created_at INTEGER NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (user_id),
+            FOREIGN KEY (company_name) REFERENCES companies (company_name)
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_orders_open ON orders (company_name, order_id) WHERE status = 'open'",
+        "CREATE INDEX IF NOT EXISTS idx_orders_user_status ON orders (user_id, status)",
+    )),
+    # Local copy of Politics and War nation details, so lookups don't need the API every time
+    (10, (
+        """CREATE TABLE IF NOT EXISTS nations (
+            nation_id INTEGER PRIMARY KEY,
+            nation_name TEXT NOT NULL,
+            discord TEXT,
+            updated_at INTEGER NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_nations_name ON nations (nation_name COLLATE NOCASE)",
+    )),
+    # Append-only trade ledger. Every trade is written as two rows, one per party, so a user's or
+    # a company's history is a single index range scan in time order.
+    (11, (
+        """CREATE TABLE IF NOT EXISTS transactions (
+            transaction_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at INTEGER NOT NULL,
+            user_id TEXT NOT NULL,
+            counterparty_id TEXT,
+            company_name TEXT NOT NULL,
+            side TEXT NOT NULL CHECK (side IN ('buy', 'sell')),
+            kind TEXT NOT NULL CHECK (kind IN ('company', 'market', 'order')),
+            shares INTEGER NOT NULL,
+            price REAL NOT NULL,
+            total_value REAL NOT NULL,
+            reference_id INTEGER
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_transactions_user_created ON transactions (user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_transactions_company_created ON transactions (company_name, created_at)",
+        """CREATE TRIGGER IF NOT EXISTS transactions_no_update BEFORE UPDATE ON transactions
+        BEGIN SELECT RAISE(ABORT, 'transactions is append-only'); END""",
+        """CREATE TRIGGER IF NOT EXISTS transactions_no_delete BEFORE DELETE ON transactions
+        BEGIN SELECT RAISE(ABORT, 'transactions is append-only'); END""",
+    )),
+    # Dividends are kept once paid and marked with when they were paid out
+    (12, (
+        "ALTER TABLE dividends ADD COLUMN paid_at TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_dividends_unpaid ON dividends (payout_date) WHERE paid_at IS NULL",
+        "CREATE INDEX IF NOT EXISTS idx_user_shares_company ON user_shares (company_name, user_id)",
+    )),
+    # Holders of a company, largest first; also serves the company lookups of the index it replaces
+    (13, (
+        "DROP INDEX IF EXISTS idx_user_shares_company",
+        "CREATE INDEX IF NOT EXISTS idx_user_shares_company_shares ON user_shares (company_name, shares DESC, user_id)",
+    )),
+    # Trade quantities alongside trade prices, for the VWAP
+    (14, (
+        "ALTER TABLE share_price ADD COLUMN shares INTEGER",
+    )),
+)
+
+# Graph period -> (seconds covered, candle resolution in seconds read for it)
+HISTORY_PERIODS = {
+    "1h": (3600, 300),
+    "12h": (12 * 3600, 3600),
+    "1d": (86400, 3600),
+    "3d": (3 * 86400, 3600),
+    "7d": (7 * 86400, 86400),
+}
+
+# Trades averaged into a company's share price after each trade
+PRICE_WINDOW = 5
+
+def normalize_payout_date(payout_date):
+    # '2026-1-5' -> '2026-01-05'; dividend dates are compared as text against CURRENT_DATE
+    return datetime.datetime.strptime(payout_date, '%Y-%m-%d').date().isoformat()
+
+class StaleOrderError(RuntimeError):
+    # A fill named a resting order that is no longer open with that many shares left, i.e. the
+    # in-memory book the fill came from is out of date
+    def __init__(self, order_id):
+        super().__init__(f"Order {order_id} is no longer open")
+        self.order_id = order_id
 
 class DatabaseUser:
-    def __init__(self, db_name='user.db'):
+    def __init__(self, db_name='user.db', pool_size=4, cached_statements=256):
         self.db_name = db_name  # Initialize the database path
-    
+        self.pool_size = pool_size
+        self.cached_statements = cached_statements  # Prepared statements kept per connection
+        self._pool = None
+        self._connections = []
+        # Write-through cache of company rows: company_name -> dict of the companies/total_shares
+        # columns, plus company_id -> company_name. Loaded in init_db, and every method that
+        # changes a company updates it once its write has committed.
+        self._companies = {}
+        self._company_names = {}
+        # Company changes staged inside a transaction, keyed by connection, applied on commit
+        self._staged_companies = {}
+        # Rolling trade prices per company, loaded in init_db. Trades made inside a transaction
+        # are staged per connection like company changes and recorded once it commits.
+        self.prices = PriceTracker(window=PRICE_WINDOW)
+        self._staged_prices = {}
+
+    async def _open_connection(self):
+        db = await aiosqlite.connect(self.db_name, cached_statements=self.cached_statements)
+        for pragma in PRAGMAS:
+            await db.execute(pragma)
+        return db
+
+    async def open(self):
+        # Open the pool once, later calls are no-ops (on_ready can fire again after a reconnect)
+        if self._pool is not None:
+            return
+        pool = asyncio.Queue()
+        for _ in range(self.pool_size):
+            db = await self._open_connection()
+            self._connections.append(db)
+            pool.put_nowait(db)
+        self._pool = pool
+
+    async def close(self):
+        if self._pool is None:
+            return
+        for db in self._connections:
+            await db.close()
+        self._connections = []
+        self._pool = None
+
+    @contextlib.asynccontextmanager
+    async def _connection(self):
+        if self._pool is None:
+            raise RuntimeError("Database pool is not open, call init_db() first")
+        db = await self._pool.get()
+        try:
+            yield db
+        finally:
+            # Never hand a connection back with a half-finished transaction on it
+            if db.in_transaction:
+                await db.rollback()
+            self._staged_companies.pop(id(db), None)
+            self._staged_prices.pop(id(db), None)
+            self._pool.put_nowait(db)
+
+    @contextlib.asynccontextmanager
+    async def _transaction(self):
+        # Takes the write lock up front so the whole block commits (one fsync) or rolls back together
+        async with self._connection() as db:
+            await db.execute("BEGIN IMMEDIATE")
+            yield db
+            await db.commit()
+            for company_name, changes in self._staged_companies.pop(id(db), {}).items():
+                if company_name in self._companies:
+                    self._companies[company_name].update(changes)
+            for company_name, share_price, shares in self._staged_prices.pop(id(db), ()):
+                self.prices.record(company_name, share_price, shares)
+
     async def init_db(self):
-        async with aiosqlite.connect(self.db_name) as db:
+        await self.open()
+        async with self._connection() as db:
             
             # Share Price table
             await db.execute('''
@@ -133,9 +466,93 @@ class DatabaseUser:
             deposits TEXT
             )
             ''')
+            await db.commit()
+
+            await self._migrate(db)
+            await self._load_companies(db)
+            await self._load_prices(db)
+
+    async def _migrate(self, db):
+        async with db.execute("PRAGMA user_version") as cursor:
+            (version,) = await cursor.fetchone()
+
+        for target, steps in MIGRATIONS:
+            if target <= version:
+                continue
+            await db.execute("BEGIN IMMEDIATE")
+            try:
+                for step in steps:
+                    if callable(step):
+                        await step(db)
+                    else:
+                        await db.execute(step)
+                # user_version lives in the database header, so it commits together with the steps
+                await db.execute(f"PRAGMA user_version = {target}")
+                await db.commit()
+            except Exception:
+                await db.rollback()
+                raise
+            version = target
+            print(f"Database migrated to schema version {version}")
+
+    async def _load_companies(self, db):
+        async with db.execute("""
+            SELECT c.company_id, c.company_name, c.share_price, ts.total_shares, c.user_id
+            FROM companies c
+            LEFT JOIN total_shares ts ON c.company_name = ts.company_name
+            ORDER BY c.company_id
+        """) as cursor:
+            rows = await cursor.fetchall()
+        self._companies = {}
+        self._company_names = {}
+        for row in rows:
+            self._cache_company(*row)
+
+    async def _load_prices(self, db):
+        # The last PRICE_WINDOW trades of every company, oldest first, plus all-time totals
+        async with db.execute("""
+            SELECT company_name, share_price, shares FROM (
+                SELECT company_name, share_price, shares, timestamp, id,
+                       ROW_NUMBER() OVER (PARTITION BY company_name ORDER BY timestamp DESC, id DESC) AS recent
+                FROM share_price
+            )
+            WHERE recent <= ?
+            ORDER BY company_name, timestamp, id
+        """, (PRICE_WINDOW,)) as cursor:
+            recent = await cursor.fetchall()
+        async with db.execute("SELECT company_name, SUM(share_price), COUNT(*) FROM share_price GROUP BY company_name") as cursor:
+            totals = await cursor.fetchall()
+        self.prices.seed(recent, totals)
+
+    def _cache_company(self, company_id, company_name, share_price, total_shares, user_id):
+        self._companies[company_name] = {
+            "company_id": company_id,
+            "company_name": company_name,
+            "share_price": share_price,
+            "total_shares": total_shares,
+            "user_id": str(user_id)  # The column is TEXT, ids passed in as ints are stored as text
+        }
+        self._company_names[company_id] = company_name
+
+    def _stage_company(self, db, company_name, **changes):
+        self._staged_companies.setdefault(id(db), {}).setdefault(company_name, {}).update(changes)
+
+    async def get_meta(self, key: str):
+        async with self._connection() as db:
+            async with db.execute("SELECT value FROM bot_meta WHERE key = ?", (key,)) as cursor:
+                result = await cursor.fetchone()
+                return result[0] if result else None
+
+    async def set_meta(self, key: str, value: str):
+        async with self._connection() as db:
+            await db.execute("""
+                INSERT INTO bot_meta (key, value) VALUES (?, ?)
+                ON CONFLICT(key) DO UPDATE SET value = excluded.value
+            """, (key, value))
+            await db.commit()
 
     async def add_user(self, user_id: str, nation_id: str):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connection() as db:
             await db.execute(
                 "INSERT OR REPLACE INTO users (user_id, nation_id) VALUES (?, ?)",
                 (user_id, nation_id)
@@ -143,19 +560,46 @@ class DatabaseUser:
             await db.commit()
 
     async def get_user_data_by_user_id(self, user_id: str):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connection() as db:
             async with db.execute("SELECT nation_id FROM users WHERE user_id = ?", (user_id,)) as cursor:
                 result = await cursor.fetchone()
                 return result[0] if result else None
 
     async def get_user_data_by_nation_id(self, nation_id: str):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connection() as db:
             async with db.execute("SELECT user_id FROM users WHERE nation_id = ?", (nation_id,)) as cursor:
                 result = await cursor.fetchone()
                 return result[0] if result else None
 
+    async def get_registered_nation_ids(self):
+        async with self._connection() as db:
+            async with db.execute("SELECT DISTINCT nation_id FROM users ORDER BY nation_id") as cursor:
+                return [int(nation_id) for (nation_id,) in await cursor.fetchall() if str(nation_id).isdigit()]
+
+    async def get_nation(self, nation_id: int = None, nation_name: str = None):
+        # (nation_id, nation_name, discord, updated_at) from the local nations table, names match case-insensitively
+        if nation_id is not None:
+            query, params = "SELECT nation_id, nation_name, discord, updated_at FROM nations WHERE nation_id = ?", (int(nation_id),)
+        else:
+            query, params = "SELECT nation_id, nation_name, discord, updated_at FROM nations WHERE nation_name = ? COLLATE NOCASE", (nation_name,)
+        async with self._connection() as db:
+            async with db.execute(query, params) as cursor:
+                return await cursor.fetchone()
+
+    async def store_nations(self, nations):
+        # nations are (nation_id, nation_name, discord, updated_at) rows
+        async with self._connection() as db:
+            await db.executemany("""
+                INSERT INTO nations (nation_id, nation_name, discord, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(nation_id) DO UPDATE SET
+                    nation_name = excluded.nation_name,
+                    discord = excluded.discord,
+                    updated_at = excluded.updated_at
+            """, nations)
+            await db.commit()
+
     async def add_credits(self, user_id: str, amount: int):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connection() as db:
             await db.execute("""
                 UPDATE users
                 SET credits = credits + ?
@@ -164,7 +608,7 @@ class DatabaseUser:
             await db.commit()
 
     async def get_user_credits(self, user_id: str):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connection() as db:
             async with db.execute("""
                 SELECT credits FROM users WHERE user_id = ?
             """, (user_id,)) as cursor:
@@ -172,11 +616,12 @@ class DatabaseUser:
                 return result[0] if result else None
 
     async def add_company(self, company_name: str, share_price: float, total_shares: int, user_id: str):
-        async with aiosqlite.connect(self.db_name) as db:
-            await db.execute(
+        async with self._connection() as db:
+            cursor = await db.execute(
                 "INSERT INTO companies (company_name, share_price, user_id) VALUES (?, ?, ?)",
                 (company_name, share_price, user_id)
             )
+            company_id = cursor.lastrowid
             await db.commit()
 
             await db.execute(
@@ -184,44 +629,52 @@ class DatabaseUser:
                 (company_name, total_shares)
             )
             await db.commit()
+        self._cache_company(company_id, company_name, share_price, total_shares, user_id)
 
     async def get_company(self, company_name: str = None, company_id: int = None):
-        async with aiosqlite.connect(self.db_name) as db:
-            if company_name:
-                async with db.execute("""
-                    SELECT c.company_name, c.share_price, ts.total_shares, c.user_id
-                    FROM companies c
-                    LEFT JOIN total_shares ts ON c.company_name = ts.company_name
-                    WHERE c.company_name = ?
-                """, (company_name,)) as cursor:
-                    result = await cursor.fetchone()
-                    return result  # This will be a tuple (company_name, share_price, total_shares, user_id)
-            elif company_id:
-                async with db.execute("""
-                    SELECT c.company_name, c.share_price, ts.total_shares, c.user_id
-                    FROM companies c
-                    LEFT JOIN total_shares ts ON c.company_name = ts.company_name
-                    WHERE c.company_id = ?
-                """, (company_id,)) as cursor:
-                    result = await cursor.fetchone()
-                    return result  # This will be a tuple (company_name, share_price, total_shares, user_id)
-            else:
-                raise ValueError("Either company_name or company_id must be provided")
+        # Served from the company cache
+        if company_name:
+            company = self._companies.get(company_name)
+        elif company_id:
+            company = self._companies.get(self._company_names.get(int(company_id)))
+        else:
+            raise ValueError("Either company_name or company_id must be provided")
+        if not company:
+            return None
+        return (company["company_name"], company["share_price"], company["total_shares"], company["user_id"])
 
-    async def get_company_data_by_user_id(self, user_id: str):
-        async with aiosqlite.connect(self.db_name) as db:
+    async def _fetch_company(self, db, company_name: str = None, company_id: int = None):
+        if company_name:
             async with db.execute("""
-                SELECT c.company_name, c.share_price, ts.total_shares
+                SELECT c.company_name, c.share_price, ts.total_shares, c.user_id
                 FROM companies c
                 LEFT JOIN total_shares ts ON c.company_name = ts.company_name
-                WHERE c.user_id = ?
-            """, (user_id,)) as cursor:
-                result = await cursor.fetchall()
-                return result
+                WHERE c.company_name = ?
+            """, (company_name,)) as cursor:
+                result = await cursor.fetchone()
+                return result  # This will be a tuple (company_name, share_price, total_shares, user_id)
+        elif company_id:
+            async with db.execute("""
+                SELECT c.company_name, c.share_price, ts.total_shares, c.user_id
+                FROM companies c
+                LEFT JOIN total_shares ts ON c.company_name = ts.company_name
+                WHERE c.company_id = ?
+            """, (company_id,)) as cursor:
+                result = await cursor.fetchone()
+                return result  # This will be a tuple (company_name, share_price, total_shares, user_id)
+        else:
+            raise ValueError("Either company_name or company_id must be provided")
+
+    async def get_company_data_by_user_id(self, user_id: str):
+        return [
+            (company["company_name"], company["share_price"], company["total_shares"])
+            for company in self._companies.values()
+            if str(company["user_id"]) == str(user_id)
+        ]
 
     async def get_share_price(self, company_name):
         try:
-            async with aiosqlite.connect(self.db_name) as db:
+            async with self._connection() as db:
                 async with db.execute("""
                     SELECT share_price
                     FROM share_price
@@ -236,23 +689,39 @@ class DatabaseUser:
         return None        
 
     async def get_company_price(self, share_price: str):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connection() as db:
             async with db.execute("SELECT share_price FROM companies WHERE share_price = ?", (share_price,)) as cursor:
                 result = await cursor.fetchone()
                 return result[0] if result else None
 
     async def get_all_companies(self):
-        async with aiosqlite.connect(self.db_name) as db:
+        # Served from the company cache, as (company_id, company_name, share_price, total_shares, user_id)
+        return [
+            (company["company_id"], company["company_name"], company["share_price"], company["total_shares"], company["user_id"])
+            for company in sorted(self._companies.values(), key=lambda company: company["company_id"])
+        ]
+
+    async def get_company_listing(self):
+        # Every company with its remaining, registered shares and unpaid dividends, in one query.
+        # Rows are (company_id, company_name, share_price, total_shares, user_id, registered_shares,
+        # [(dividend_per_share, payout_date), ...]).
+        async with self._connection() as db:
             async with db.execute("""
-                SELECT c.company_id, c.company_name, c.share_price, ts.total_shares, c.user_id
+                SELECT c.company_id, c.company_name, c.share_price, ts.total_shares, c.user_id, rs.registered_share,
+                       json_group_array(json_array(d.dividend_per_share, d.payout_date))
+                           FILTER (WHERE d.dividend_id IS NOT NULL)
                 FROM companies c
-                LEFT JOIN total_shares ts ON c.company_name = ts.company_name
+                LEFT JOIN total_shares ts ON ts.company_name = c.company_name
+                LEFT JOIN registered_shares rs ON rs.company_name = c.company_name
+                LEFT JOIN dividends d ON d.company_name = c.company_name AND d.paid_at IS NULL
+                GROUP BY c.company_id
+                ORDER BY c.company_id
             """) as cursor:
-                result = await cursor.fetchall()
-                return result
+                rows = await cursor.fetchall()
+        return [row[:6] + ([tuple(dividend) for dividend in json.loads(row[6])],) for row in rows]
 
     async def update_user_credits_after_purchase(self, user_id: str, amount: int):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connection() as db:
             await db.execute("""
                 UPDATE users
                 SET credits = credits - ?
@@ -261,76 +730,144 @@ class DatabaseUser:
             await db.commit()
 
     async def update_company_share_price(self, company_name: str, new_share_price: float):
-        async with aiosqlite.connect(self.db_name) as db:
-            await db.execute("""
-                UPDATE companies
-                SET share_price = ?
-                WHERE company_name = ?
-            """, (new_share_price, company_name))
-            await db.commit()
+        async with self._transaction() as db:
+            await self._set_share_price(db, company_name, new_share_price)
     async def update_company_owner(self, company_name: str, new_owner_id: str):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connection() as db:
             await db.execute(''' 
             UPDATE companies 
             SET user_id = ? 
             WHERE company_name = ? 
             ''', (new_owner_id, company_name))
             await db.commit()
+        if company_name in self._companies:
+            self._companies[company_name]["user_id"] = str(new_owner_id)
+
     async def store_share_price_history(self, company_name: str, date: str, time: str, share_price: float):
-        async with aiosqlite.connect(self.db_name) as db:
-            # First check if the record already exists
-            async with db.execute("""
-                SELECT * FROM share_price_history WHERE company_name = ? AND date = ? AND time = ?
-            """, (company_name, date, time)) as cursor:
-                result = await cursor.fetchone()
-        
-            if result is None:  # If no record exists, insert the new one
-                await db.execute("""
-                    INSERT INTO share_price_history (company_name, date, time, share_price)
-                    VALUES (?, ?, ?, ?)
-                """, (company_name, date, time, share_price))
-                await db.commit()
+        ts = int(datetime.datetime.strptime(f"{date} {time}", "%Y-%m-%d %H:%M:%S").timestamp())
+        async with self._connection() as db:
+            # The unique indexes make a repeated sample a no-op
+            await db.execute("""
+                INSERT INTO share_price_history (company_name, date, time, ts, share_price)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT DO NOTHING
+            """, (company_name, date, time, ts, share_price))
+            await db.commit()
+
+    async def snapshot_share_prices(self):
+        # Keyframe: record every company's current price in one statement and one commit. Price
+        # changes are recorded as they happen, this only anchors the series for idle companies.
+        # The whole tick shares one timestamp truncated to the minute, so running it twice in a
+        # minute is a no-op.
+        now = datetime.datetime.now().replace(second=0, microsecond=0)
+        async with self._transaction() as db:
+            cursor = await db.execute("""
+                INSERT INTO share_price_history (company_name, date, time, ts, share_price)
+                SELECT company_name, ?, ?, ?, share_price FROM companies
+                WHERE company_name IS NOT NULL
+                ON CONFLICT DO NOTHING
+            """, (now.date().isoformat(), now.strftime('%H:%M:%S'), int(now.timestamp())))
+            return cursor.rowcount
 
     async def get_share_price_history(self, company_name: str, period: str):
-        today = datetime.datetime.now()
-        if period == "1h":
-            start_time = today - datetime.timedelta(hours=1)
-            interval = datetime.timedelta(minutes=5)
-        elif period == "12h":
-            start_time = today - datetime.timedelta(hours=12)
-            interval = datetime.timedelta(minutes=60)
-        elif period == "1d":
-            start_time = today - datetime.timedelta(days=1)
-            interval = datetime.timedelta(minutes=120)
-        elif period == "3d":
-            start_time = today - datetime.timedelta(days=3)
-            interval = datetime.timedelta(minutes=720)
-        elif period == "7d":
-            start_time = today - datetime.timedelta(days=7)
-            interval = datetime.timedelta(minutes=1440)
-        else:
+        # Returns (ts, share_price) change points for the period, ts being unix epoch seconds,
+        # read from the candle resolution the period needs
+        candles = await self.get_price_candles(company_name, period)
+        if candles is None:
             return None
+        start_time, result = candles
+        # Each candle's close is the price from its last tick on; a candle that closed before the
+        # window started gives the price at the start
+        points = [(max(close_ts, start_time), close) for bucket, open, high, low, close, close_ts in result]
 
-        start_time = start_time.strftime("%Y-%m-%d %H:%M:%S")
-    
-        async with aiosqlite.connect(self.db_name) as db:
-            async with db.execute(
-                "SELECT date, time, share_price FROM share_price_history WHERE company_name = ? AND datetime(date || ' ' || time) >= ? ORDER BY date, time",
-                (company_name, start_time)
-            ) as cursor:
+        now = int(datetime.datetime.now().timestamp())
+        if points:
+            # The price holds until now
+            points.append((now, points[-1][1]))
+        return points
+
+    async def get_latest_history_row(self, company_name: str):
+        # (id, ts, share_price) of the newest history row, None if the company has no history
+        async with self._connection() as db:
+            async with db.execute("""
+                SELECT id, ts, share_price FROM share_price_history
+                WHERE company_name = ? AND ts IS NOT NULL
+                ORDER BY ts DESC
+                LIMIT 1
+            """, (company_name,)) as cursor:
+                return await cursor.fetchone()
+
+    async def get_price_candles(self, company_name: str, period: str):
+        # Returns (start_time, [(bucket, open, high, low, close, close_ts), ...]). The first candle
+        # may start before start_time: it is the last one before the window, so the series has
+        # a known price at the window's start.
+        if period not in HISTORY_PERIODS:
+            return None
+        seconds, resolution = HISTORY_PERIODS[period]
+        now = int(datetime.datetime.now().timestamp())
+        start_time = now - seconds
+        first_bucket = start_time - start_time % resolution
+
+        async with self._connection() as db:
+            async with db.execute("""
+                SELECT bucket, open, high, low, close, close_ts FROM price_candles
+                WHERE company_name = ? AND resolution = ? AND bucket < ?
+                ORDER BY bucket DESC
+                LIMIT 1
+            """, (company_name, resolution, first_bucket)) as cursor:
+                seed = await cursor.fetchone()
+            async with db.execute("""
+                SELECT bucket, open, high, low, close, close_ts FROM price_candles
+                WHERE company_name = ? AND resolution = ? AND bucket BETWEEN ? AND ?
+                ORDER BY bucket
+            """, (company_name, resolution, first_bucket, now)) as cursor:
                 result = await cursor.fetchall()
-                return result
+
+        if seed:
+            result.insert(0, seed)
+        return start_time, result
     
     async def get_company_name(self, company_name: str):
-        async with aiosqlite.connect(self.db_name) as db:
-            async with db.execute("SELECT share_price FROM companies WHERE company_name = ?", (company_name,)) as cursor:
-                result = await cursor.fetchone()
-                if result:
-                    return result[0]  # Return the actual share price
-                return None
+        company = self._companies.get(company_name)
+        if company:
+            return company["share_price"]  # Return the actual share price
+        return None
+
+    async def get_portfolio(self, user_id: str):
+        # Balance plus every holding valued at the company's current price, in one query.
+        # None if the user isn't registered.
+        async with self._connection() as db:
+            async with db.execute("""
+                SELECT u.credits, c.company_name, us.shares, c.share_price
+                FROM users u
+                LEFT JOIN user_shares us ON us.user_id = u.user_id AND us.shares > 0
+                LEFT JOIN companies c ON c.company_name = us.company_name
+                WHERE u.user_id = ?
+                ORDER BY us.shares * c.share_price DESC
+            """, (user_id,)) as cursor:
+                rows = await cursor.fetchall()
+        if not rows:
+            return None
+
+        holdings = [
+            {
+                "company_name": company_name,
+                "shares": shares,
+                "share_price": share_price,
+                "worth": shares * share_price
+            }
+            for credits, company_name, shares, share_price in rows
+            if company_name is not None
+        ]
+        return {
+            "user_id": user_id,
+            "credits": rows[0][0] or 0,
+            "holdings": holdings,
+            "total_worth": sum(holding["worth"] for holding in holdings)
+        }
 
     async def get_user_shares(self, user_id: str, company_name: str) -> int:
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connection() as db:
             async with db.execute("""
                 SELECT shares FROM user_shares WHERE user_id = ? AND company_name = ?
             """, (user_id, company_name)) as cursor:
@@ -338,58 +875,63 @@ class DatabaseUser:
                 return result[0] if result else 0
 
     async def update_user_shares(self, user_id: str, company_name: str, shares_change: int):
-        async with aiosqlite.connect(self.db_name) as db:
-            current_shares = await self.get_user_shares(user_id, company_name)
-            new_shares = current_shares + shares_change
+        async with self._connection() as db:
+            await self._change_shares(db, user_id, company_name, shares_change)
+            await db.commit()
 
-            if new_shares < 0:
-                raise ValueError("User cannot have negative shares.")
+    async def _change_shares(self, db, user_id: str, company_name: str, shares_change: int):
+        current_shares = await self._fetch_shares(db, user_id, company_name)
+        new_shares = current_shares + shares_change
 
-            await db.execute("""
-                INSERT INTO user_shares (user_id, company_name, shares)
-                VALUES (?, ?, ?)
-                ON CONFLICT(user_id, company_name) DO UPDATE SET shares=excluded.shares
-            """, (user_id, company_name, new_shares))
-            await db.commit()
+        if new_shares < 0:
+            raise ValueError("User cannot have negative shares.")
+
+        await db.execute("""
+            INSERT INTO user_shares (user_id, company_name, shares)
+            VALUES (?, ?, ?)
+            ON CONFLICT(user_id, company_name) DO UPDATE SET shares=excluded.shares
+        """, (user_id, company_name, new_shares))
+        return new_shares
 
     async def remove_company(self, company_name: str):
-        async with aiosqlite.connect(self.db_name) as db:
+        # Removes the company and everything keyed on it in one transaction. Its open orders are
+        # cancelled first and their escrow handed back. Returns the cancelled orders as
+        # (order_id, user_id, side, price, remaining).
+        async with self._transaction() as db:
+            async with db.execute("""
+                UPDATE orders SET status = 'cancelled'
+                WHERE company_name = ? AND status = 'open'
+                RETURNING order_id, user_id, side, price, remaining
+            """, (company_name,)) as cursor:
+                cancelled = await cursor.fetchall()
+            for _, user_id, side, price, remaining in cancelled:
+                await self._release_escrow(db, user_id, company_name, side, price, remaining)
+
             # Remove from user_shares table first to prevent foreign key constraint issues
             await db.execute("DELETE FROM user_shares WHERE company_name = ?", (company_name,))
-            await db.commit()
-        
-            # Remove from share_price_history table
+
+            # Remove from share_price_history and its candles
             await db.execute("DELETE FROM share_price_history WHERE company_name = ?", (company_name,))
-            await db.commit()
+            await db.execute("DELETE FROM price_candles WHERE company_name = ?", (company_name,))
 
             # Finally, remove from companies table
             await db.execute("DELETE FROM companies WHERE company_name = ?", (company_name,))
-            await db.commit()
 
             # Remove from total_shares table
             await db.execute("DELETE FROM total_shares WHERE company_name = ?", (company_name,))
-            await db.commit()
 
+        company = self._companies.pop(company_name, None)
+        if company:
+            self._company_names.pop(company["company_id"], None)
         print(f"Company {company_name} has been removed from the database.")
+        return cancelled
         
     async def update_company_details(self, company_name: str, new_share_price: float, new_total_shares: int):
-        async with aiosqlite.connect(self.db_name) as db:
-            await db.execute("""
-                UPDATE companies
-                SET share_price = ?
-                WHERE company_name = ?
-            """, (new_share_price, company_name))
-            await db.commit()
-
-            await db.execute("""
-                UPDATE total_shares
-                SET total_shares = ?
-                WHERE company_name = ?
-            """, (new_total_shares, company_name))
-            await db.commit()
+        async with self._transaction() as db:
+            await self._set_company(db, company_name, new_share_price, new_total_shares)
             
     async def add_shares(self, company_name: str, registered_share: int):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connection() as db:
             await db.execute("""
             INSERT INTO registered_shares (company_name, registered_share)
             VALUES (?, ?)
@@ -399,7 +941,7 @@ class DatabaseUser:
 
             
     async def get_shares(self, company_name: str):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connection() as db:
             async with db.execute("""
             SELECT registered_share FROM registered_shares WHERE company_name = ?
             """, (company_name,)) as cursor:
@@ -407,7 +949,7 @@ class DatabaseUser:
                 return result[0] if result else None
             
     async def get_all_trades(self):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connection() as db:
             async with db.execute("""
             SELECT trade_id, seller_id, company_name, shares_available, price_per_share
             FROM trades
@@ -415,13 +957,46 @@ class DatabaseUser:
                 result = await cursor.fetchall()
                 return result
             
+    def _market_filter(self, viewer_id, company_name):
+        # Public trades plus direct trades to or from the viewer
+        conditions = ["(to_user_id IS NULL OR to_user_id = ? OR seller_id = ?)"]
+        params = [viewer_id, viewer_id]
+        if company_name:
+            conditions.append("company_name = ?")
+            params.append(company_name)
+        return conditions, params
+
+    async def get_market_trades(self, viewer_id: int, company_name: str = None, after: tuple = None, limit: int = 10):
+        # One page of the order book as seen by viewer_id, cheapest first. after is the
+        # (price_per_share, trade_id) of the last trade on the previous page (keyset pagination).
+        conditions, params = self._market_filter(viewer_id, company_name)
+        if after:
+            conditions.append("(price_per_share, trade_id) > (?, ?)")
+            params.extend(after)
+        async with self._connection() as db:
+            async with db.execute(f"""
+                SELECT trade_id, seller_id, company_name, shares_available, price_per_share, to_user_id
+                FROM trades
+                WHERE {' AND '.join(conditions)}
+                ORDER BY price_per_share, trade_id
+                LIMIT ?
+            """, (*params, limit)) as cursor:
+                return await cursor.fetchall()
+
+    async def count_market_trades(self, viewer_id: int, company_name: str = None):
+        conditions, params = self._market_filter(viewer_id, company_name)
+        async with self._connection() as db:
+            async with db.execute(f"SELECT COUNT(*) FROM trades WHERE {' AND '.join(conditions)}", params) as cursor:
+                (count,) = await cursor.fetchone()
+                return count
+
     async def get_trade_by_id(self, trade_id: int):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connection() as db:
             async with db.execute("SELECT * FROM trades WHERE trade_id = ?", (trade_id,)) as cursor:
                 result = await cursor.fetchone()
                 return result        
     async def create_trade(self, company_name: str, seller_id: int, num_shares: int, price_per_share: float, to_user_id: int = None):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connection() as db:
             await db.execute("""
             INSERT INTO trades (company_name, seller_id, shares_available, price_per_share, to_user_id)
             VALUES (?, ?, ?, ?, ?)
@@ -429,12 +1004,12 @@ class DatabaseUser:
             await db.commit()
             
     async def delete_trade(self, trade_id: int):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connection() as db:
             # Remove the trade from the trades table
             await db.execute("DELETE FROM trades WHERE trade_id = ?", (trade_id,))
             await db.commit()
     async def get_trade(self, trade_id: int):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connection() as db:
             async with db.execute("""
             SELECT trade_id, seller_id, company_name, shares_available, price_per_share, to_user_id
             FROM trades
@@ -452,7 +1027,7 @@ class DatabaseUser:
                     }
                 return None
     async def update_trade(self, trade_id: int, remaining_shares: int):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connection() as db:
             await db.execute("""
             UPDATE trades
             SET shares_available = ?
@@ -460,28 +1035,32 @@ class DatabaseUser:
             """, (remaining_shares, trade_id))
             await db.commit()      
     async def post_dividend(self, company_name: str, dividend_per_share: float, payout_date: str):
-        async with aiosqlite.connect(self.db_name) as db:
-            await db.execute('''
+        # Returns the new dividend's id. The date is stored zero-padded (YYYY-MM-DD) so it compares
+        # correctly against CURRENT_DATE; raises ValueError if it isn't a valid date.
+        payout_date = normalize_payout_date(payout_date)
+        async with self._connection() as db:
+            cursor = await db.execute('''
             INSERT INTO dividends (company_name, dividend_per_share, payout_date, total_payout)
             VALUES (?, ?, ?, ?)
             ''', (company_name, dividend_per_share, payout_date, 0))
             await db.commit()
+            return cursor.lastrowid
     async def get_dividends(self, company_name: str):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connection() as db:
             async with db.execute(''' 
             SELECT dividend_per_share, payout_date FROM dividends 
             WHERE company_name = ? 
             ''', (company_name,)) as cursor:
                 return await cursor.fetchall()
     async def delete_dividend(self, company_name: str, payout_date: str):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connection() as db:
             await db.execute(''' 
             DELETE FROM dividends 
             WHERE company_name = ? AND payout_date = ? 
             ''', (company_name, payout_date))
             await db.commit()
     async def update_dividend_total_payout(self, company_name: str, payout_date: str, total_payout: float):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connection() as db:
             await db.execute(''' 
             UPDATE dividends 
             SET total_payout = ? 
@@ -489,49 +1068,103 @@ class DatabaseUser:
             ''', (total_payout, company_name, payout_date))
             await db.commit()
     async def get_user_dividend_payouts(self, user_id: str):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connection() as db:
             async with db.execute(''' 
             SELECT company_name, amount, payout_date FROM dividend_payouts 
             WHERE user_id = ? 
             ''', (user_id,)) as cursor:
                 return await cursor.fetchall()
     async def get_due_dividends(self, company_name):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connection() as db:
             async with db.execute(''' 
             SELECT company_name, dividend_per_share, payout_date FROM dividends 
-            WHERE payout_date <= CURRENT_DATE 
+            WHERE company_name = ? AND payout_date <= CURRENT_DATE AND paid_at IS NULL
+            ''', (company_name,)) as cursor:
+                return await cursor.fetchall()
+    async def is_dividend_unpaid(self, dividend_id: int):
+        async with self._connection() as db:
+            async with db.execute("SELECT 1 FROM dividends WHERE dividend_id = ? AND paid_at IS NULL", (dividend_id,)) as cursor:
+                return await cursor.fetchone() is not None
+
+    async def set_dividend_payout_date(self, dividend_id: int, payout_date: str):
+        async with self._connection() as db:
+            await db.execute("UPDATE dividends SET payout_date = ? WHERE dividend_id = ?", (payout_date, dividend_id))
+            await db.commit()
+
+    async def get_unpaid_dividends(self):
+        # (dividend_id, payout_date) of every dividend still to be paid, for the payout scheduler
+        async with self._connection() as db:
+            async with db.execute('''
+            SELECT dividend_id, payout_date FROM dividends
+            WHERE paid_at IS NULL
+            ORDER BY payout_date
             ''') as cursor:
                 return await cursor.fetchall()
     async def distribute_dividends(self, company_name: str):
-        async with aiosqlite.connect(self.db_name) as db:
+        # Pays every due, unpaid dividend of the company. Each one is a single UPDATE ... FROM over
+        # the holders plus a single INSERT ... SELECT of their payouts, and the dividend is marked
+        # paid in the same transaction, so nothing is paid twice and the cost barely depends on the
+        # number of holders. Returns the paid dividends as (dividend_per_share, payout_date, total_payout, holders).
+        async with self._transaction() as db:
             async with db.execute('''
-            SELECT dividend_per_share FROM dividends
-            WHERE company_name = ? AND payout_date <= CURRENT_DATE
+            SELECT dividend_id, dividend_per_share, payout_date FROM dividends
+            WHERE company_name = ? AND payout_date <= CURRENT_DATE AND paid_at IS NULL
+            ORDER BY payout_date, dividend_id
             ''', (company_name,)) as cursor:
-                dividend_info = await cursor.fetchone()
-                if not dividend_info:
-                    return
-                dividend_per_share = dividend_info[0]
-                async with db.execute('''
-                SELECT user_id, shares FROM user_shares
-                WHERE company_name = ?
-                ''', (company_name,)) as user_cursor:
-                    users_with_shares = await user_cursor.fetchall()
-                    for user_id, shares in users_with_shares:
-                        total_dividend = shares * dividend_per_share
-                        await db.execute('''
-                        UPDATE users
-                        SET credits = credits + ?
-                        WHERE user_id = ?
-                        ''', (total_dividend, user_id))
-                        await db.execute('''
-                        INSERT INTO dividend_payouts (user_id, company_name, amount, payout_date)
-                        VALUES (?, ?, ?, CURRENT_DATE)
-                        ''', (user_id, company_name, total_dividend))
-                        await db.commit()
-                        
+                due = await cursor.fetchall()
+
+            paid = []
+            for dividend_id, dividend_per_share, payout_date in due:
+                paid.append((dividend_per_share, payout_date, *await self._pay_dividend(db, dividend_id, company_name, dividend_per_share)))
+            return paid
+
+    async def pay_dividend(self, dividend_id: int):
+        # Pays one dividend if it is due and still unpaid. Returns
+        # (company_name, dividend_per_share, payout_date, total_payout, holders), or None if there was nothing to pay.
+        async with self._transaction() as db:
+            async with db.execute('''
+            SELECT company_name, dividend_per_share, payout_date FROM dividends
+            WHERE dividend_id = ? AND payout_date <= CURRENT_DATE AND paid_at IS NULL
+            ''', (dividend_id,)) as cursor:
+                dividend = await cursor.fetchone()
+            if not dividend:
+                return None
+            company_name, dividend_per_share, payout_date = dividend
+            return (company_name, dividend_per_share, payout_date, *await self._pay_dividend(db, dividend_id, company_name, dividend_per_share))
+
+    async def _pay_dividend(self, db, dividend_id, company_name, dividend_per_share):
+        # Only registered users holding shares are paid
+        async with db.execute('''
+        SELECT COUNT(*), COALESCE(SUM(us.shares), 0)
+        FROM user_shares us
+        JOIN users u ON u.user_id = us.user_id
+        WHERE us.company_name = ? AND us.shares > 0
+        ''', (company_name,)) as cursor:
+            holders, shares = await cursor.fetchone()
+        total_payout = shares * dividend_per_share
+
+        await db.execute('''
+        INSERT INTO dividend_payouts (user_id, company_name, amount, payout_date)
+        SELECT us.user_id, us.company_name, us.shares * ?, CURRENT_DATE
+        FROM user_shares us
+        JOIN users u ON u.user_id = us.user_id
+        WHERE us.company_name = ? AND us.shares > 0
+        ''', (dividend_per_share, company_name))
+        await db.execute('''
+        UPDATE users
+        SET credits = credits + us.shares * ?
+        FROM user_shares us
+        WHERE us.user_id = users.user_id AND us.company_name = ? AND us.shares > 0
+        ''', (dividend_per_share, company_name))
+        await db.execute('''
+        UPDATE dividends
+        SET paid_at = CURRENT_TIMESTAMP, total_payout = ?
+        WHERE dividend_id = ?
+        ''', (total_payout, dividend_id))
+        return total_payout, holders
+
     async def add_depo(self, company_name: str, deposits: str):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connection() as db:
             await db.execute(
                 "INSERT INTO deposits (company_name, deposits) VALUES (?, ?)",
                 (company_name, deposits)
@@ -539,7 +1172,7 @@ class DatabaseUser:
             await db.commit()
             
     async def get_depo(self, company_name):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connection() as db:
             async with db.execute("""
                 SELECT deposits FROM deposits WHERE company_name = ?
             """, (company_name,)) as cursor:
@@ -548,7 +1181,7 @@ class DatabaseUser:
             
     async def update_trade(self, trade_id: int, shares_available: int = None, price_per_share: float = None):
         try:
-            async with aiosqlite.connect(self.db_name) as db:
+            async with self._connection() as db:
                 if shares_available is not None:
                     await db.execute("UPDATE trades SET shares_available = ? WHERE trade_id = ?", (shares_available, trade_id))
                 if price_per_share is not None:
@@ -558,49 +1191,409 @@ class DatabaseUser:
             raise Exception(f"Error updating trade: {str(e)}")
 
     async def delete_trade(self, trade_id: int):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connection() as db:
             trade = await db.execute("SELECT * FROM trades WHERE trade_id = ?", (trade_id,))
             if not trade:
                 raise ValueError(f"Trade {trade_id} not found!")
             await db.execute("DELETE FROM trades WHERE trade_id = ?", (trade_id,))
             await db.commit() 
 
-    async def insert_share_price_history(self, company_name, share_price, timestamp):
-        async with aiosqlite.connect(self.db_name) as db:
+    async def insert_share_price_history(self, company_name, share_price, timestamp, shares: int = None):
+        async with self._connection() as db:
             await db.execute("""
-                INSERT INTO share_price (company_name, share_price, timestamp)
-                VALUES (?, ?, ?)
-            """, (company_name, share_price, timestamp))
+                INSERT INTO share_price (company_name, share_price, timestamp, shares)
+                VALUES (?, ?, ?, ?)
+            """, (company_name, share_price, timestamp, shares))
             await db.commit()
+        self.prices.record(company_name, share_price, shares)
 
     async def get_average_price(self, company_name):
-        async with aiosqlite.connect(self.db_name) as db:
-            async with db.execute("""
-                SELECT AVG(share_price)
-                FROM share_price
-                WHERE company_name = ?
-                ORDER BY timestamp DESC
-                LIMIT 5
-            """, (company_name,)) as cursor:
-                result = await cursor.fetchall()
-                if result:
-                    return result[0][0]
-                else:
-                    return None
-                
+        # Average of the last PRICE_WINDOW trade prices
+        return self.prices.average(company_name)
+
+    async def get_vwap(self, company_name):
+        # Volume-weighted average over the last PRICE_WINDOW trades
+        return self.prices.vwap(company_name)
+
     async def get_average_price_all_trades(self, company_name):
-        async with aiosqlite.connect(self.db_name) as db:
+        return self.prices.all_time_average(company_name)
+
+    def _rolling_price(self, db, company_name):
+        # The company's new price from the trades so far, counting the ones staged in this transaction
+        pending = [price for name, price, _ in self._staged_prices.get(id(db), ()) if name == company_name]
+        return self.prices.average(company_name, pending)
+
+    async def get_top_shareholders(self, company_name: str, limit: int = 20, offset: int = 0):
+        # (user_id, shares, percent of the registered shares) for the company's holders, largest first.
+        # percent is None when the company has no registered shares.
+        async with self._connection() as db:
             async with db.execute("""
-                SELECT AVG(share_price)
-                FROM share_price
-                WHERE company_name = ?
-            """, (company_name,)) as cursor:
-                result = await cursor.fetchall()
-                return result[0][0]
-            
+                SELECT us.user_id, us.shares, us.shares * 100.0 / NULLIF(rs.registered_share, 0)
+                FROM user_shares us
+                LEFT JOIN registered_shares rs ON rs.company_name = us.company_name
+                WHERE us.company_name = ? AND us.shares > 0
+                ORDER BY us.shares DESC, us.user_id
+                LIMIT ? OFFSET ?
+            """, (company_name, limit, offset)) as cursor:
+                return await cursor.fetchall()
+
+    async def count_shareholders(self, company_name: str):
+        async with self._connection() as db:
+            async with db.execute("SELECT COUNT(*) FROM user_shares WHERE company_name = ? AND shares > 0", (company_name,)) as cursor:
+                (count,) = await cursor.fetchone()
+                return count
+
     async def get_shareholders(self, company_name):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connection() as db:
             async with db.execute("SELECT user_id, company_name, shares FROM user_shares WHERE company_name = ?", (company_name,)) as cursor:
                 shareholders = await cursor.fetchall()
             return shareholders
-    
+
+    async def execute_trade(self, trade_type: str, user_id: str, num_shares: int, company_name: str = None, company_id: int = None, trade_id: int = None):
+        # Runs a whole trade (balance check, share and credit moves, price tick, company update)
+        # in one transaction. trade_type is "Buy" (from the company), "Sell" (back to the company)
+        # or "Market" (from a posted trade). Raises ValueError with a user facing message and
+        # writes nothing if the trade can't go through.
+        if not num_shares or num_shares <= 0:
+            raise ValueError("Number of shares must be a positive number.")
+        timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+        async with self._transaction() as db:
+            if trade_type == "Buy":
+                return await self._buy_from_company(db, user_id, num_shares, company_name, company_id, timestamp)
+            elif trade_type == "Sell":
+                return await self._sell_to_company(db, user_id, num_shares, company_name, company_id)
+            elif trade_type == "Market":
+                return await self._buy_from_market(db, user_id, num_shares, trade_id, timestamp)
+            else:
+                raise ValueError(f"Unknown trade type: {trade_type}")
+
+    async def _buy_from_company(self, db, user_id, num_shares, company_name, company_id, timestamp):
+        company = await self._fetch_company(db, company_name, company_id)
+        if not company:
+            raise ValueError("Invalid company ID or name.")
+        company_name, share_price, total_shares, company_owner_id = company
+        total_shares = total_shares or 0
+
+        if total_shares < num_shares:
+            raise ValueError(f"Not enough shares available. Available Shares: {total_shares}")
+
+        share_price = round(float(share_price), 2)
+        total_cost = round(num_shares * share_price, 2)
+
+        user_balance = await self._fetch_credits(db, user_id)
+        if user_balance is None or user_balance < total_cost:
+            raise ValueError("You don't have enough coins to buy these shares.")
+
+        # Move the shares and coins, the company's owner gets paid
+        await self._change_shares(db, user_id, company_name, num_shares)
+        await self._change_credits(db, user_id, -total_cost)
+        await self._change_credits(db, company_owner_id, total_cost)
+        await self._insert_price(db, company_name, share_price, timestamp, num_shares)
+        await self._record_transaction(db, "company", company_name, user_id, company_owner_id, num_shares, share_price, total_cost)
+
+        new_price = self._rolling_price(db, company_name)
+        await self._set_company(db, company_name, new_price, total_shares - num_shares)
+
+        return {
+            "company_name": company_name,
+            "num_shares": num_shares,
+            "share_price": share_price,
+            "total_value": total_cost,
+            "seller_id": company_owner_id,
+            "new_price": new_price
+        }
+
+    async def _sell_to_company(self, db, user_id, num_shares, company_name, company_id):
+        company = await self._fetch_company(db, company_name, company_id)
+        if not company:
+            raise ValueError("Invalid company name.")
+        company_name, share_price, total_shares, company_owner_id = company
+        total_shares = total_shares or 0
+        share_price = round(float(share_price), 2)
+
+        user_shares = await self._fetch_shares(db, user_id, company_name)
+        if user_shares < num_shares:
+            raise ValueError("You don't have enough shares to sell.")
+
+        total_value = round(num_shares * share_price, 2)
+
+        # The seller gets paid out of the company's owner's balance
+        await self._change_shares(db, user_id, company_name, -num_shares)
+        await self._change_credits(db, user_id, total_value)
+        await self._change_credits(db, company_owner_id, -total_value)
+        await self._record_transaction(db, "company", company_name, company_owner_id, user_id, num_shares, share_price, total_value)
+
+        # Reduce the share price slightly when shares are sold
+        if total_shares == 0:
+            new_price = round(share_price * 0.90, 2)
+        else:
+            new_price = round(share_price * (1 + (num_shares / total_shares) ** 1.1), 2) - share_price
+            new_price = share_price - max(30, new_price)
+
+        await self._set_company(db, company_name, new_price, total_shares + num_shares)
+
+        return {
+            "company_name": company_name,
+            "num_shares": num_shares,
+            "share_price": share_price,
+            "total_value": total_value,
+            "seller_id": user_id,
+            "new_price": new_price
+        }
+
+    async def _buy_from_market(self, db, user_id, num_shares, trade_id, timestamp):
+        async with db.execute("""
+            SELECT seller_id, company_name, shares_available, price_per_share, to_user_id
+            FROM trades
+            WHERE trade_id = ?
+        """, (trade_id,)) as cursor:
+            trade = await cursor.fetchone()
+        if not trade:
+            raise ValueError("Trade not found. Please check the trade ID.")
+        seller_id, company_name, shares_available, price_per_share, to_user_id = trade
+
+        # Direct trades can only be bought by the user they were posted to
+        if to_user_id and str(user_id) != str(to_user_id):
+            raise ValueError(f"This trade is only available to <@{to_user_id}>.")
+
+        if num_shares > shares_available:
+            raise ValueError(f"Not enough shares available. Only {shares_available} shares are left.")
+
+        total_cost = num_shares * price_per_share
+
+        buyer_credits = await self._fetch_credits(db, user_id)
+        if buyer_credits is None or buyer_credits < total_cost:
+            raise ValueError(f"You don't have enough credits to buy {num_shares} shares of {company_name}. Total cost is ${total_cost:,}.")
+
+        await self._insert_price(db, company_name, price_per_share, timestamp, num_shares)
+
+        # Transfer credits and shares
+        await self._change_credits(db, user_id, -total_cost)
+        await self._change_credits(db, seller_id, total_cost)
+        await self._change_shares(db, seller_id, company_name, -num_shares)
+        await self._change_shares(db, user_id, company_name, num_shares)
+        await self._record_transaction(db, "market", company_name, user_id, seller_id, num_shares, price_per_share, total_cost, trade_id)
+
+        # Update or remove the trade from the market
+        remaining_shares = shares_available - num_shares
+        if remaining_shares > 0:
+            await db.execute("UPDATE trades SET shares_available = ? WHERE trade_id = ?", (remaining_shares, trade_id))
+        else:
+            await db.execute("DELETE FROM trades WHERE trade_id = ?", (trade_id,))
+
+        new_price = None
+        company = await self._fetch_company(db, company_name)
+        if company:
+            new_price = self._rolling_price(db, company_name)
+            await self._set_company(db, company_name, new_price, company[2])
+
+        return {
+            "company_name": company_name,
+            "num_shares": num_shares,
+            "share_price": price_per_share,
+            "total_value": total_cost,
+            "seller_id": seller_id,
+            "new_price": new_price
+        }
+
+    async def get_open_orders(self):
+        # Every resting order, oldest first, for rebuilding the in-memory books at startup
+        async with self._connection() as db:
+            async with db.execute("""
+                SELECT order_id, user_id, company_name, side, price, remaining
+                FROM orders
+                WHERE status = 'open'
+                ORDER BY order_id
+            """) as cursor:
+                return await cursor.fetchall()
+
+    async def get_order(self, order_id: int):
+        # (order_id, user_id, company_name, side, price, remaining, status), None if there is no such order
+        async with self._connection() as db:
+            async with db.execute("""
+                SELECT order_id, user_id, company_name, side, price, remaining, status
+                FROM orders
+                WHERE order_id = ?
+            """, (order_id,)) as cursor:
+                return await cursor.fetchone()
+
+    async def place_order(self, user_id: str, company_name: str, side: str, price: float, shares: int, fills: list):
+        # Settles a new limit order in one transaction: escrow for the whole order, the order row,
+        # every fill against the resting orders it crossed, and the price update.
+        # fills are (maker_order_id, maker_user_id, maker_price, shares) in match order; every
+        # fill executes at the maker's price. Returns (order_id, new_price), new_price being None
+        # when nothing filled. Raises ValueError with a user facing message if the order can't
+        # be placed, and StaleOrderError if a maker order can't take its fill; nothing is changed
+        # in either case.
+        async with self._transaction() as db:
+            if not await self._fetch_company(db, company_name):
+                raise ValueError("Invalid company name.")
+
+            if side == "bid":
+                cost = round(price * shares, 2)
+                credits = await self._fetch_credits(db, user_id)
+                if credits is None or credits < cost:
+                    raise ValueError(f"You don't have enough coins to bid for {shares} shares at ${price:,}. Total cost is ${cost:,}.")
+                await self._change_credits(db, user_id, -cost)
+            else:
+                if await self._fetch_shares(db, user_id, company_name) < shares:
+                    raise ValueError(f"You don't have enough shares of {company_name} to sell.")
+                await self._change_shares(db, user_id, company_name, -shares)
+
+            filled = sum(fill[3] for fill in fills)
+            now = int(datetime.datetime.now().timestamp())
+            cursor = await db.execute("""
+                INSERT INTO orders (user_id, company_name, side, price, shares, remaining, status, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (str(user_id), company_name, side, price, shares, shares - filled,
+                  "open" if filled < shares else "filled", now))
+            order_id = cursor.lastrowid
+
+            timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            for maker_order_id, maker_user_id, maker_price, fill_shares in fills:
+                cursor = await db.execute("""
+                    UPDATE orders
+                    SET remaining = remaining - ?,
+                        status = CASE WHEN remaining = ? THEN 'filled' ELSE status END
+                    WHERE order_id = ? AND status = 'open' AND remaining >= ?
+                """, (fill_shares, fill_shares, maker_order_id, fill_shares))
+                if not cursor.rowcount:
+                    raise StaleOrderError(maker_order_id)
+
+                buyer_id, seller_id = (user_id, maker_user_id) if side == "bid" else (maker_user_id, user_id)
+                await self._settle_fill(db, buyer_id, seller_id, company_name, maker_price, fill_shares)
+                await self._record_transaction(db, "order", company_name, buyer_id, seller_id, fill_shares,
+                                               maker_price, round(maker_price * fill_shares, 2), order_id)
+                if side == "bid":
+                    # The bid escrowed its own limit price, hand back the difference
+                    await self._change_credits(db, user_id, round((price - maker_price) * fill_shares, 2))
+                await self._insert_price(db, company_name, maker_price, timestamp, fill_shares)
+
+            new_price = None
+            if fills:
+                new_price = self._rolling_price(db, company_name)
+                await self._set_share_price(db, company_name, new_price)
+
+            return order_id, new_price
+
+    async def _settle_fill(self, db, buyer_id, seller_id, company_name, price, shares):
+        # The buyer's coins and the seller's shares were escrowed when their orders were placed
+        await self._change_shares(db, buyer_id, company_name, shares)
+        await self._change_credits(db, seller_id, round(price * shares, 2))
+
+    async def cancel_order(self, order_id: int, user_id: str):
+        # Cancels an open order and releases what is left of its escrow. Returns the
+        # cancelled order's (company_name, side, price, remaining).
+        async with self._transaction() as db:
+            async with db.execute("""
+                UPDATE orders SET status = 'cancelled'
+                WHERE order_id = ? AND user_id = ? AND status = 'open'
+                RETURNING company_name, side, price, remaining
+            """, (order_id, str(user_id))) as cursor:
+                order = await cursor.fetchone()
+            if not order:
+                raise ValueError(f"You have no open order with ID {order_id}.")
+
+            await self._release_escrow(db, user_id, *order)
+            return order
+
+    async def _release_escrow(self, db, user_id, company_name, side, price, remaining):
+        # Hands back what an order escrowed for its unfilled remainder
+        if side == "bid":
+            await self._change_credits(db, user_id, round(price * remaining, 2))
+        else:
+            await self._change_shares(db, user_id, company_name, remaining)
+
+    async def _record_transaction(self, db, kind, company_name, buyer_id, seller_id, shares, price, total_value, reference_id=None):
+        # One ledger row for each side of the trade; reference_id is the market trade or order it came from
+        now = int(datetime.datetime.now().timestamp())
+        await db.executemany("""
+            INSERT INTO transactions (created_at, user_id, counterparty_id, company_name, side, kind, shares, price, total_value, reference_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            (now, str(buyer_id), str(seller_id), company_name, "buy", kind, shares, price, total_value, reference_id),
+            (now, str(seller_id), str(buyer_id), company_name, "sell", kind, shares, price, total_value, reference_id),
+        ))
+
+    def _history_filter(self, user_id, company_name, since):
+        conditions = ["user_id = ?"]
+        params = [str(user_id)]
+        if company_name:
+            conditions.append("company_name = ?")
+            params.append(company_name)
+        if since is not None:
+            conditions.append("created_at >= ?")
+            params.append(since)
+        return conditions, params
+
+    async def get_transactions(self, user_id: str, company_name: str = None, since: int = None, before: tuple = None, limit: int = 10):
+        # One page of a user's ledger, newest first. since is an epoch second to start from, before
+        # the (created_at, transaction_id) of the last row on the previous page (keyset pagination).
+        conditions, params = self._history_filter(user_id, company_name, since)
+        if before:
+            conditions.append("(created_at, transaction_id) < (?, ?)")
+            params.extend(before)
+        async with self._connection() as db:
+            async with db.execute(f"""
+                SELECT transaction_id, created_at, counterparty_id, company_name, side, kind, shares, price, total_value, reference_id
+                FROM transactions
+                WHERE {' AND '.join(conditions)}
+                ORDER BY created_at DESC, transaction_id DESC
+                LIMIT ?
+            """, (*params, limit)) as cursor:
+                return await cursor.fetchall()
+
+    async def count_transactions(self, user_id: str, company_name: str = None, since: int = None):
+        conditions, params = self._history_filter(user_id, company_name, since)
+        async with self._connection() as db:
+            async with db.execute(f"SELECT COUNT(*) FROM transactions WHERE {' AND '.join(conditions)}", params) as cursor:
+                (count,) = await cursor.fetchone()
+                return count
+
+    async def _fetch_credits(self, db, user_id):
+        async with db.execute("SELECT credits FROM users WHERE user_id = ?", (user_id,)) as cursor:
+            result = await cursor.fetchone()
+            return result[0] if result else None
+
+    async def _fetch_shares(self, db, user_id, company_name):
+        async with db.execute("""
+            SELECT shares FROM user_shares WHERE user_id = ? AND company_name = ?
+        """, (user_id, company_name)) as cursor:
+            result = await cursor.fetchone()
+            return result[0] if result else 0
+
+    async def _change_credits(self, db, user_id, amount):
+        await db.execute("UPDATE users SET credits = credits + ? WHERE user_id = ?", (amount, user_id))
+
+    async def _insert_price(self, db, company_name, share_price, timestamp, shares):
+        await db.execute("""
+            INSERT INTO share_price (company_name, share_price, timestamp, shares)
+            VALUES (?, ?, ?, ?)
+        """, (company_name, share_price, timestamp, shares))
+        self._staged_prices.setdefault(id(db), []).append((company_name, share_price, shares))
+
+    async def _set_company(self, db, company_name, new_share_price, new_total_shares):
+        await self._set_share_price(db, company_name, new_share_price)
+        cursor = await db.execute("UPDATE total_shares SET total_shares = ? WHERE company_name = ?", (new_total_shares, company_name))
+        if cursor.rowcount:
+            self._stage_company(db, company_name, total_shares=new_total_shares)
+
+    async def _set_share_price(self, db, company_name, new_share_price):
+        # Only an actual price change is written to share_price_history
+        cursor = await db.execute("""
+            UPDATE companies SET share_price = ?
+            WHERE company_name = ? AND share_price IS NOT ?
+        """, (new_share_price, company_name, new_share_price))
+        if cursor.rowcount:
+            await self._record_price_tick(db, company_name, new_share_price)
+            self._stage_company(db, company_name, share_price=new_share_price)
+
+    async def _record_price_tick(self, db, company_name, share_price):
+        # Several changes within the same second keep the last price
+        now = datetime.datetime.now().replace(microsecond=0)
+        await db.execute("""
+            INSERT INTO share_price_history (company_name, date, time, ts, share_price)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(company_name, ts) DO UPDATE SET share_price = excluded.share_price
+        """, (company_name, now.date().isoformat(), now.strftime('%H:%M:%S'), int(now.timestamp()), share_price))
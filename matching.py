@@ -0,0 +1,208 @@
+import asyncio
+import heapq
+
+from db import StaleOrderError
+
+SIDES = ("bid", "ask")
+# Times an order is matched again after its fills hit resting orders the book had out of date
+STALE_RETRIES = 3
+
+class Order:
+    __slots__ = ("order_id", "user_id", "company_name", "side", "price", "remaining")
+
+    def __init__(self, order_id, user_id, company_name, side, price, remaining):
+        self.order_id = order_id
+        self.user_id = str(user_id)
+        self.company_name = company_name
+        self.side = side
+        self.price = price
+        self.remaining = remaining
+
+class OrderBook:
+    # Resting orders for one company. Each side is a heap keyed for price-time priority
+    # (highest bid / lowest ask first, then lowest order_id), so the best order is read in O(1)
+    # and orders are added or taken off in O(log n). Cancelled orders are only dropped from
+    # self.orders; their heap entries are skipped when they reach the top.
+    def __init__(self):
+        self.orders = {}
+        self.bids = []
+        self.asks = []
+        self.stale = 0
+
+    def _heap(self, side):
+        return self.bids if side == "bid" else self.asks
+
+    @staticmethod
+    def _key(order):
+        return (-order.price if order.side == "bid" else order.price, order.order_id)
+
+    def add(self, order):
+        self.orders[order.order_id] = order
+        heapq.heappush(self._heap(order.side), (*self._key(order), order.order_id))
+
+    def remove(self, order_id):
+        order = self.orders.pop(order_id, None)
+        if order is not None:
+            self.stale += 1
+            self._compact()
+        return order
+
+    def _compact(self):
+        # Rebuild once dead entries make up most of the heaps, so they can't grow without bound
+        if self.stale <= len(self.orders) + 64:
+            return
+        self.bids = [entry for entry in self.bids if entry[-1] in self.orders]
+        self.asks = [entry for entry in self.asks if entry[-1] in self.orders]
+        heapq.heapify(self.bids)
+        heapq.heapify(self.asks)
+        self.stale = 0
+
+    def _pop(self, side):
+        heap = self._heap(side)
+        while heap:
+            order = self.orders.get(heapq.heappop(heap)[-1])
+            if order is not None:
+                return order
+            self.stale -= 1
+        return None
+
+    def match(self, user_id, side, price, shares):
+        # Works out the fills an incoming order would get without changing the book.
+        # Returns [(maker order, shares)] best price first; the maker's own orders are passed over.
+        opposite = "ask" if side == "bid" else "bid"
+        fills = []
+        taken = []
+        try:
+            while shares > 0:
+                order = self._pop(opposite)
+                if order is None:
+                    break
+                taken.append(order)
+                if (order.price > price) if side == "bid" else (order.price < price):
+                    break
+                if order.user_id == str(user_id):
+                    continue
+                fill = min(shares, order.remaining)
+                fills.append((order, fill))
+                shares -= fill
+        finally:
+            # Put back everything looked at; fills are only applied once they have settled
+            heap = self._heap(opposite)
+            for order in taken:
+                heapq.heappush(heap, (*self._key(order), order.order_id))
+        return fills
+
+    def apply(self, fills):
+        for order, shares in fills:
+            order.remaining -= shares
+            if order.remaining <= 0:
+                self.remove(order.order_id)
+
+    def best(self, side):
+        heap = self._heap(side)
+        while heap and heap[0][-1] not in self.orders:
+            heapq.heappop(heap)
+            self.stale -= 1
+        return self.orders[heap[0][-1]] if heap else None
+
+    def levels(self, side, depth=10):
+        # Best price levels on one side as [(price, shares, orders)]
+        totals = {}
+        for order in self.orders.values():
+            if order.side == side:
+                shares, count = totals.get(order.price, (0, 0))
+                totals[order.price] = (shares + order.remaining, count + 1)
+        prices = heapq.nlargest(depth, totals) if side == "bid" else heapq.nsmallest(depth, totals)
+        return [(price, *totals[price]) for price in prices]
+
+class MatchingEngine:
+    # Limit orders with price-time priority. The books live in memory and the orders table is
+    # the record: an incoming order is matched against its company's book, the order and all of
+    # its fills are settled in one transaction by db.place_order, and only then is the book changed.
+    # Orders for one company are matched one at a time. Should the book have drifted from the
+    # table, the stale resting orders are refreshed from it and the order is matched again.
+    def __init__(self, db):
+        self.db = db
+        self.books = {}
+        self._locks = {}
+
+    def book(self, company_name):
+        if company_name not in self.books:
+            self.books[company_name] = OrderBook()
+        return self.books[company_name]
+
+    def _lock(self, company_name):
+        if company_name not in self._locks:
+            self._locks[company_name] = asyncio.Lock()
+        return self._locks[company_name]
+
+    async def load(self):
+        self.books = {}
+        for row in await self.db.get_open_orders():
+            order = Order(*row)
+            self.book(order.company_name).add(order)
+
+    async def place(self, user_id, company_name, side, price, shares):
+        # Returns (order, fills): the order as it rests on the book (remaining 0 once it fully
+        # filled) and its fills as [(maker order, shares)]. Raises ValueError like db.place_order.
+        if side not in SIDES:
+            raise ValueError("Side must be bid or ask.")
+        if shares <= 0:
+            raise ValueError("Number of shares must be a positive number.")
+        price = round(float(price), 2)
+        if price <= 0:
+            raise ValueError("Price must be a positive number.")
+
+        # Checked before a book and lock are made for it, so a mistyped name doesn't leave them behind
+        if not await self.db.get_company(company_name):
+            raise ValueError("Invalid company name.")
+
+        async with self._lock(company_name):
+            book = self.book(company_name)
+            for _ in range(STALE_RETRIES):
+                fills = book.match(user_id, side, price, shares)
+                try:
+                    order_id, new_price = await self.db.place_order(
+                        user_id, company_name, side, price, shares,
+                        [(maker.order_id, maker.user_id, maker.price, fill) for maker, fill in fills]
+                    )
+                    break
+                except StaleOrderError as e:
+                    await self._refresh(book, e.order_id)
+            else:
+                raise ValueError("The order book changed while your order was being placed, please try again.")
+            book.apply(fills)
+
+            order = Order(order_id, user_id, company_name, side, price, shares - sum(fill for _, fill in fills))
+            if order.remaining > 0:
+                book.add(order)
+            return order, fills
+
+    async def _refresh(self, book, order_id):
+        # Brings one resting order in line with the orders table, dropping it once it is closed
+        row = await self.db.get_order(order_id)
+        if row is None or row[6] != "open" or row[5] <= 0:
+            book.remove(order_id)
+        elif order_id in book.orders:
+            book.orders[order_id].remaining = row[5]
+
+    async def remove_company(self, company_name):
+        # Removes the company through db.remove_company, which cancels and refunds its open
+        # orders, then forgets its book. Returns the cancelled orders.
+        async with self._lock(company_name):
+            cancelled = await self.db.remove_company(company_name)
+            self.books.pop(company_name, None)
+        self._locks.pop(company_name, None)
+        return cancelled
+
+    async def cancel(self, user_id, order_id):
+        # Returns the cancelled order's (company_name, side, price, remaining)
+        company_name = next((name for name, book in self.books.items() if order_id in book.orders), None)
+        if company_name is None:
+            raise ValueError(f"You have no open order with ID {order_id}.")
+
+        # Under the company's lock so the order can't be filled while it is being cancelled
+        async with self._lock(company_name):
+            order = await self.db.cancel_order(order_id, user_id)
+            self.book(company_name).remove(order_id)
+        return order
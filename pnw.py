@@ -0,0 +1,212 @@
+import asyncio
+import random
+import time
+from collections import OrderedDict
+
+import aiohttp
+
+API_URL = "https://api.politicsandwar.com/graphql"
+
+NATIONS_QUERY = """
+query ($id: [Int], $nation_name: [String], $first: Int, $page: Int) {
+    nations(id: $id, nation_name: $nation_name, first: $first, page: $page) {
+        data { %s }
+        paginatorInfo { currentPage hasMorePages }
+    }
+}
+"""
+
+class PnWError(Exception):
+    pass
+
+class HTTPTransport:
+    # Posts GraphQL requests over one shared aiohttp session. The connector keeps connections to
+    # the API alive between requests, so lookups after the first skip the TCP and TLS handshakes.
+    # Failed requests (timeouts, connection errors, 429 and 5xx, and bodies that aren't a JSON
+    # object, e.g. a maintenance page) are retried with exponential backoff, honouring
+    # Retry-After when the API sends one.
+    def __init__(self, url, params=None, timeout=10, retries=3, backoff=0.5, limit=10):
+        self.url = url
+        self.params = params or {}
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=min(timeout, 5))
+        self.retries = retries
+        self.backoff = backoff
+        self.limit = limit
+        self._session = None
+
+    def _get_session(self):
+        # Created on first use so it belongs to the running event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, keepalive_timeout=60, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout, raise_for_status=False)
+        return self._session
+
+    async def request(self, payload):
+        session = self._get_session()
+        for attempt in range(self.retries + 1):
+            retry_after = None
+            try:
+                async with session.post(self.url, params=self.params, json=payload) as response:
+                    if response.status == 429 or response.status >= 500:
+                        retry_after = response.headers.get("Retry-After")
+                        error = PnWError(f"Politics and War API returned HTTP {response.status}")
+                    elif response.status >= 400:
+                        raise PnWError(f"Politics and War API returned HTTP {response.status}: {await response.text()}")
+                    else:
+                        try:
+                            result = await response.json(content_type=None)
+                        except ValueError:
+                            result = None
+                        if isinstance(result, dict):
+                            return result
+                        error = PnWError("Politics and War API returned a malformed response")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = PnWError(f"Politics and War API request failed: {e!r}")
+
+            if attempt == self.retries:
+                raise error
+            delay = self.backoff * 2 ** attempt * (1 + random.random())
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            await asyncio.sleep(delay)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+class PnWClient:
+    # Async Politics and War GraphQL client. Any object with `async request(payload) -> dict` and
+    # `async close()` can be passed as transport, e.g. one posting to a local fake server via
+    # HTTPTransport(url) or one answering in process.
+    def __init__(self, api_key, url=API_URL, transport=None, **transport_options):
+        self.transport = transport or HTTPTransport(url, params={"api_key": api_key}, **transport_options)
+
+    async def query(self, query, variables=None):
+        result = await self.transport.request({"query": query, "variables": variables or {}})
+        if result.get("errors"):
+            raise PnWError("; ".join(error.get("message", str(error)) for error in result["errors"]))
+        if not result.get("data"):
+            raise PnWError("Politics and War API returned no data")
+        return result["data"]
+
+    async def nations(self, fields=("id", "nation_name"), first=50, page=1, **filters):
+        # One page of nations matching filters (id=[...], nation_name=[...]).
+        # Returns (nations as dicts, whether more pages follow).
+        data = await self.query(NATIONS_QUERY % " ".join(fields), {**filters, "first": first, "page": page})
+        nations = data["nations"]
+        return nations["data"], nations["paginatorInfo"]["hasMorePages"]
+
+    async def nation(self, nation_id=None, nation_name=None, fields=("id", "nation_name")):
+        # A single nation by id or name, None if there is no such nation
+        filters = {"id": [int(nation_id)]} if nation_id is not None else {"nation_name": [nation_name]}
+        nations, _ = await self.nations(fields, first=1, **filters)
+        return nations[0] if nations else None
+
+    async def close(self):
+        await self.transport.close()
+
+class NationCache:
+    # Nation id/name/discord lookups in front of the API, in two tiers: a bounded in-memory LRU
+    # whose entries expire after ttl seconds, then the nations table (through db) for rows
+    # younger than db_ttl. Only when both miss is the API asked, and the answer fills both tiers.
+    # Nations are returned as {"id": int, "nation_name": str, "discord": str}.
+    FIELDS = ("id", "nation_name", "discord")
+
+    def __init__(self, client, db=None, ttl=6 * 3600, db_ttl=24 * 3600, max_entries=1024):
+        self.client = client
+        self.db = db
+        self.ttl = ttl
+        self.db_ttl = db_ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # nation_id -> (expires at, nation)
+        self.names = {}  # lower-cased nation_name -> nation_id
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    def _get_memory(self, nation_id, nation_name):
+        if nation_id is None:
+            nation_id = self.names.get(nation_name.lower())
+        entry = self.entries.get(nation_id)
+        if entry is None:
+            return None
+        expires, nation = entry
+        if expires < time.monotonic():
+            self._forget(nation_id)
+            return None
+        self.entries.move_to_end(nation_id)
+        return nation
+
+    def _forget(self, nation_id):
+        _, nation = self.entries.pop(nation_id)
+        if self.names.get(nation["nation_name"].lower()) == nation_id:
+            del self.names[nation["nation_name"].lower()]
+
+    def put(self, nation):
+        nation_id = nation["id"]
+        if nation_id in self.entries:
+            self._forget(nation_id)
+        self.entries[nation_id] = (time.monotonic() + self.ttl, nation)
+        self.names[nation["nation_name"].lower()] = nation_id
+        while len(self.entries) > self.max_entries:
+            self._forget(next(iter(self.entries)))
+
+    async def get(self, nation_id=None, nation_name=None, refresh=False):
+        # A nation by id or name, None if the API doesn't know it. refresh skips both cache tiers.
+        if nation_id is not None:
+            nation_id = int(nation_id)
+        if not refresh:
+            nation = self._get_memory(nation_id, nation_name)
+            if nation is not None:
+                self.hits += 1
+                return nation
+
+            if self.db is not None:
+                row = await self.db.get_nation(nation_id=nation_id, nation_name=nation_name)
+                if row and row[3] > time.time() - self.db_ttl:
+                    nation = {"id": row[0], "nation_name": row[1], "discord": row[2]}
+                    self.put(nation)
+                    self.db_hits += 1
+                    return nation
+
+        self.misses += 1
+        result = await self.client.nation(nation_id=nation_id, nation_name=nation_name, fields=self.FIELDS)
+        if result is None:
+            return None
+        nation = {"id": int(result["id"]), "nation_name": result["nation_name"], "discord": result.get("discord")}
+        self.put(nation)
+        if self.db is not None:
+            await self.db.store_nations([(nation["id"], nation["nation_name"], nation["discord"], int(time.time()))])
+        return nation
+
+    async def sync(self, nation_ids, batch_size=500):
+        # Refreshes the nations table for every id in nation_ids with one paginated query per
+        # batch_size ids, instead of one request per nation. Returns the number of nations stored.
+        nation_ids = list(nation_ids)
+        stored = 0
+        for start in range(0, len(nation_ids), batch_size):
+            batch = nation_ids[start:start + batch_size]
+            page = 1
+            more = True
+            while more:
+                nations, more = await self.client.nations(self.FIELDS, first=batch_size, page=page, id=batch)
+                now = int(time.time())
+                rows = [(int(nation["id"]), nation["nation_name"], nation.get("discord"), now) for nation in nations]
+                if rows:
+                    await self.db.store_nations(rows)
+                # Keep whatever is already in memory consistent with the table
+                for nation_id, nation_name, discord, _ in rows:
+                    if nation_id in self.entries:
+                        self.put({"id": nation_id, "nation_name": nation_name, "discord": discord})
+                stored += len(rows)
+                page += 1
+        return stored
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "entries": len(self.entries)
+        }
@@ -0,0 +1,83 @@
+from collections import deque
+
+class PriceSeries:
+    # The last `window` trades of one company as (price, shares), with their sums kept up to date
+    # as trades come in and fall out, plus all-time totals. Trades recorded before quantities were
+    # stored have shares None and count towards the averages but not the VWAP.
+    __slots__ = ("trades", "price_sum", "value_sum", "share_sum", "total_sum", "total_count")
+
+    def __init__(self, window):
+        self.trades = deque(maxlen=window)
+        self.price_sum = 0.0
+        self.value_sum = 0.0
+        self.share_sum = 0
+        self.total_sum = 0.0
+        self.total_count = 0
+
+    def record(self, price, shares=None, all_time=True):
+        if len(self.trades) == self.trades.maxlen:
+            old_price, old_shares = self.trades[0]
+            self.price_sum -= old_price
+            if old_shares:
+                self.value_sum -= old_price * old_shares
+                self.share_sum -= old_shares
+        self.trades.append((price, shares))
+        self.price_sum += price
+        if shares:
+            self.value_sum += price * shares
+            self.share_sum += shares
+        if all_time:
+            self.total_sum += price
+            self.total_count += 1
+
+class PriceTracker:
+    # Rolling trade prices for every company, in memory. Each trade updates its company's series
+    # in O(1), so the last-N average, the VWAP and the all-time average are read without touching
+    # the share_price table. Seeded from that table at startup.
+    def __init__(self, window=5):
+        self.window = window
+        self.series = {}
+
+    def _series(self, company_name):
+        if company_name not in self.series:
+            self.series[company_name] = PriceSeries(self.window)
+        return self.series[company_name]
+
+    def seed(self, recent, totals):
+        # recent: (company_name, price, shares) rows, oldest first, at most window per company.
+        # totals: (company_name, price sum, trade count) over all of a company's trades.
+        self.series = {}
+        for company_name, price, shares in recent:
+            self._series(company_name).record(price, shares, all_time=False)
+        for company_name, price_sum, count in totals:
+            series = self._series(company_name)
+            series.total_sum = price_sum
+            series.total_count = count
+
+    def record(self, company_name, price, shares=None):
+        self._series(company_name).record(price, shares)
+
+    def average(self, company_name, pending=()):
+        # Average of the last window trade prices. pending are prices of trades not recorded yet,
+        # e.g. ones inside an open transaction, counted as the newest trades.
+        series = self.series.get(company_name)
+        if not pending:
+            return series.price_sum / len(series.trades) if series and series.trades else None
+        if len(pending) >= self.window:
+            return sum(pending[-self.window:]) / self.window
+        kept = self.window - len(pending)
+        prices = [price for price, _ in series.trades][-kept:] if series else []
+        return (sum(prices) + sum(pending)) / (len(prices) + len(pending))
+
+    def vwap(self, company_name):
+        # Volume-weighted average price over the last window trades
+        series = self.series.get(company_name)
+        if not series or not series.share_sum:
+            return None
+        return series.value_sum / series.share_sum
+
+    def all_time_average(self, company_name):
+        series = self.series.get(company_name)
+        if not series or not series.total_count:
+            return None
+        return series.total_sum / series.total_count
@@ -0,0 +1,230 @@
+import asyncio
+
+import pytest
+
+from db import DatabaseUser, StaleOrderError
+from matching import MatchingEngine
+
+COMPANY = "ACME"
+USERS = ("buyer1", "buyer2", "seller1", "seller2")
+CREDITS = 10000
+SHARES = 100
+
+def run(coro):
+    return asyncio.run(coro)
+
+async def open_market(path):
+    # A company with two buyers holding coins and two sellers holding coins and shares
+    db = DatabaseUser(str(path / "test.db"))
+    await db.init_db()
+    await db.add_company(COMPANY, 10, 1000, "owner")
+    for user_id in USERS:
+        await db.add_user(user_id, user_id)
+        await db.add_credits(user_id, CREDITS)
+    for user_id in ("seller1", "seller2"):
+        await db.update_user_shares(user_id, COMPANY, SHARES)
+    engine = MatchingEngine(db)
+    await engine.load()
+    return db, engine
+
+async def order_row(db, order_id):
+    row = await db.get_order(order_id)
+    return row[6], row[5]
+
+async def count_trades(db):
+    return sum([await db.count_transactions(user_id) for user_id in USERS])
+
+async def assert_conserved(db, engine):
+    # Coins and shares only move between users and the escrow of open orders
+    credits = sum([await db.get_user_credits(user_id) for user_id in USERS])
+    shares = sum([await db.get_user_shares(user_id, COMPANY) for user_id in USERS])
+    book = engine.book(COMPANY)
+    escrowed_credits = sum(order.price * order.remaining for order in book.orders.values() if order.side == "bid")
+    escrowed_shares = sum(order.remaining for order in book.orders.values() if order.side == "ask")
+    assert credits + escrowed_credits == pytest.approx(CREDITS * len(USERS))
+    assert shares + escrowed_shares == 2 * SHARES
+
+def test_price_time_priority(tmp_path):
+    async def scenario():
+        db, engine = await open_market(tmp_path)
+        try:
+            dear, _ = await engine.place("seller1", COMPANY, "ask", 12, 5)
+            first, _ = await engine.place("seller2", COMPANY, "ask", 10, 5)
+            second, _ = await engine.place("seller1", COMPANY, "ask", 10, 5)
+
+            order, fills = await engine.place("buyer1", COMPANY, "bid", 12, 12)
+            # Best price first, then the older order at the same price; fills trade at the maker's price
+            assert [(maker.order_id, shares) for maker, shares in fills] == [
+                (first.order_id, 5), (second.order_id, 5), (dear.order_id, 2)
+            ]
+            assert order.remaining == 0
+            assert await db.get_user_credits("buyer1") == pytest.approx(CREDITS - (50 + 50 + 24))
+            assert await db.get_user_shares("buyer1", COMPANY) == 12
+            assert await db.get_user_credits("seller2") == pytest.approx(CREDITS + 50)
+            assert engine.book(COMPANY).best("ask").order_id == dear.order_id
+            await assert_conserved(db, engine)
+        finally:
+            await db.close()
+
+    run(scenario())
+
+def test_partial_fills(tmp_path):
+    async def scenario():
+        db, engine = await open_market(tmp_path)
+        try:
+            ask, _ = await engine.place("seller1", COMPANY, "ask", 10, 10)
+
+            await engine.place("buyer1", COMPANY, "bid", 10, 4)
+            assert engine.book(COMPANY).orders[ask.order_id].remaining == 6
+            assert await order_row(db, ask.order_id) == ("open", 6)
+
+            bid, fills = await engine.place("buyer2", COMPANY, "bid", 10, 10)
+            assert [(maker.order_id, shares) for maker, shares in fills] == [(ask.order_id, 6)]
+            assert await order_row(db, ask.order_id) == ("filled", 0)
+            assert ask.order_id not in engine.book(COMPANY).orders
+            # The rest of the bid rests on the book
+            assert bid.remaining == 4
+            assert engine.book(COMPANY).best("bid").order_id == bid.order_id
+            assert await order_row(db, bid.order_id) == ("open", 4)
+            await assert_conserved(db, engine)
+        finally:
+            await db.close()
+
+    run(scenario())
+
+def test_self_match_is_skipped(tmp_path):
+    async def scenario():
+        db, engine = await open_market(tmp_path)
+        try:
+            own, _ = await engine.place("seller1", COMPANY, "ask", 10, 5)
+            other, _ = await engine.place("seller2", COMPANY, "ask", 11, 5)
+
+            bid, fills = await engine.place("seller1", COMPANY, "bid", 11, 5)
+            # Passes over its own cheaper ask and fills against the other seller
+            assert [(maker.order_id, shares) for maker, shares in fills] == [(other.order_id, 5)]
+            assert bid.remaining == 0
+            assert engine.book(COMPANY).orders[own.order_id].remaining == 5
+            assert await order_row(db, own.order_id) == ("open", 5)
+
+            bid, fills = await engine.place("seller1", COMPANY, "bid", 10, 5)
+            assert fills == []
+            assert bid.remaining == 5
+            await assert_conserved(db, engine)
+        finally:
+            await db.close()
+
+    run(scenario())
+
+def test_cancel_refunds_escrow(tmp_path):
+    async def scenario():
+        db, engine = await open_market(tmp_path)
+        try:
+            bid, _ = await engine.place("buyer1", COMPANY, "bid", 10, 5)
+            assert await db.get_user_credits("buyer1") == pytest.approx(CREDITS - 50)
+            assert await engine.cancel("buyer1", bid.order_id) == (COMPANY, "bid", 10, 5)
+            assert await db.get_user_credits("buyer1") == pytest.approx(CREDITS)
+
+            ask, _ = await engine.place("seller1", COMPANY, "ask", 10, 8)
+            await engine.place("buyer2", COMPANY, "bid", 10, 3)
+            assert await db.get_user_shares("seller1", COMPANY) == SHARES - 8
+            # Only what is left of a partly filled order comes back
+            await engine.cancel("seller1", ask.order_id)
+            assert await db.get_user_shares("seller1", COMPANY) == SHARES - 3
+            assert await order_row(db, ask.order_id) == ("cancelled", 5)
+            assert not engine.book(COMPANY).orders
+
+            with pytest.raises(ValueError):
+                await engine.cancel("seller1", ask.order_id)
+            other, _ = await engine.place("seller2", COMPANY, "ask", 10, 1)
+            with pytest.raises(ValueError):
+                await engine.cancel("seller1", other.order_id)
+            await assert_conserved(db, engine)
+        finally:
+            await db.close()
+
+    run(scenario())
+
+def test_invalid_company_leaves_no_book(tmp_path):
+    async def scenario():
+        db, engine = await open_market(tmp_path)
+        try:
+            with pytest.raises(ValueError):
+                await engine.place("buyer1", "ACEM", "bid", 10, 5)
+            assert "ACEM" not in engine.books
+            assert "ACEM" not in engine._locks
+            assert await db.get_user_credits("buyer1") == pytest.approx(CREDITS)
+        finally:
+            await db.close()
+
+    run(scenario())
+
+def test_fill_against_closed_maker_rolls_back(tmp_path):
+    async def scenario():
+        db, engine = await open_market(tmp_path)
+        try:
+            ask, _ = await engine.place("seller1", COMPANY, "ask", 10, 5)
+            await db.cancel_order(ask.order_id, "seller1")
+            share_price = (await db.get_company(COMPANY))[1]
+
+            with pytest.raises(StaleOrderError):
+                await db.place_order("buyer1", COMPANY, "bid", 10, 5, [(ask.order_id, "seller1", 10, 5)])
+
+            assert await db.get_user_credits("buyer1") == pytest.approx(CREDITS)
+            assert await db.get_user_shares("buyer1", COMPANY) == 0
+            assert await db.get_user_shares("seller1", COMPANY) == SHARES
+            assert await db.get_open_orders() == []
+            assert await count_trades(db) == 0
+            assert await order_row(db, ask.order_id) == ("cancelled", 5)
+            assert (await db.get_company(COMPANY))[1] == share_price
+        finally:
+            await db.close()
+
+    run(scenario())
+
+def test_stale_makers_are_refreshed(tmp_path):
+    async def scenario():
+        db, engine = await open_market(tmp_path)
+        try:
+            closed, _ = await engine.place("seller1", COMPANY, "ask", 10, 5)
+            partial, _ = await engine.place("seller2", COMPANY, "ask", 11, 5)
+            # Changed behind the engine's back, so its book still shows both asks in full
+            await db.cancel_order(closed.order_id, "seller1")
+            await db.place_order("buyer2", COMPANY, "bid", 11, 3, [(partial.order_id, "seller2", 11, 3)])
+
+            order, fills = await engine.place("buyer1", COMPANY, "bid", 11, 5)
+            assert [(maker.order_id, shares) for maker, shares in fills] == [(partial.order_id, 2)]
+            assert order.remaining == 3
+            book = engine.book(COMPANY)
+            assert closed.order_id not in book.orders
+            assert partial.order_id not in book.orders
+            assert await order_row(db, partial.order_id) == ("filled", 0)
+            assert await db.get_user_shares("buyer1", COMPANY) == 2
+            assert await db.get_user_credits("buyer1") == pytest.approx(CREDITS - 55)
+        finally:
+            await db.close()
+
+    run(scenario())
+
+def test_remove_company_refunds_open_orders(tmp_path):
+    async def scenario():
+        db, engine = await open_market(tmp_path)
+        try:
+            bid, _ = await engine.place("buyer1", COMPANY, "bid", 9, 5)
+            ask, _ = await engine.place("seller1", COMPANY, "ask", 12, 5)
+
+            cancelled = await engine.remove_company(COMPANY)
+            assert sorted(order_id for order_id, *_ in cancelled) == [bid.order_id, ask.order_id]
+            assert await db.get_user_credits("buyer1") == pytest.approx(CREDITS)
+            assert await order_row(db, bid.order_id) == ("cancelled", 5)
+            assert await order_row(db, ask.order_id) == ("cancelled", 5)
+            assert await db.get_open_orders() == []
+            assert await db.get_company(COMPANY) is None
+            assert COMPANY not in engine.books
+            assert COMPANY not in engine._locks
+
+            with pytest.raises(ValueError):
+                await engine.place("buyer1", COMPANY, "bid", 9, 5)
+        finally:
+            await db.close()
+
+    run(scenario())